@@ -0,0 +1,468 @@
+"""
+Benchmarks of the attachment pipeline
+
+Usage:
+    python benchmark.py generate <folder> [--count N] [--pages P]
+    python benchmark.py run <folder> [--baseline FILE] [--save-baseline FILE]
+    python benchmark.py compare <folder> [--repeat N] [--compare fast|engines|all]
+    python benchmark.py memory <folder> [--full-layout]
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+from main import (
+    PDF_ENGINES, RowStats, create_sink, extract_vat_package_weight, get_files_paths,
+    is_attachment, print_separator, summary
+)
+
+
+def pdf_escape(text):
+    """
+    Escape text for a PDF string literal
+
+    :param text: Text line
+    """
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, font_size=10, leading=13):
+    """
+    Write a minimal text-only PDF (Helvetica, A4) without extra dependencies
+
+    :param path: Output path
+    :param pages: List of pages, each a list of text lines
+    :param font_size: Font size in points
+    :param leading: Line spacing in points
+    """
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    }
+    kids = []
+    for idx, lines in enumerate(pages):
+        page_id, content_id = 4 + 2 * idx, 5 + 2 * idx
+        ops = ["BT", f"/F1 {font_size} Tf", f"{leading} TL", "40 800 Td"]
+        ops += [f"({pdf_escape(line)}) Tj T*" for line in lines]
+        ops.append("ET")
+        content = "\n".join(ops).encode("cp1252", errors="replace")
+        kids.append(f"{page_id} 0 R")
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode()
+        objects[content_id] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode()
+
+    buf = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = len(buf)
+        buf += b"%d 0 obj\n%s\nendobj\n" % (obj_id, objects[obj_id])
+    xref = len(buf)
+    size = max(objects) + 1
+    buf += b"xref\n0 %d\n0000000000 65535 f \n" % size
+    for obj_id in range(1, size):
+        buf += b"%010d 00000 n \n" % offsets[obj_id]
+    buf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref)
+
+    with open(path, "wb") as f:
+        f.write(buf)
+
+
+def polish_number(value, decimals):
+    """
+    Format number the way attachments do ("1 234,50")
+
+    :param value: Number
+    :param decimals: Decimal places
+    """
+    return f"{value:,.{decimals}f}".replace(",", " ").replace(".", ",")
+
+
+def item_lines(rng, count):
+    """
+    Random invoice item lines used as page filler
+
+    :param rng: random.Random instance
+    :param count: Number of lines
+    """
+    goods = ["Kabel", "Obudowa", "Modul", "Zasilacz", "Czujnik", "Przewod", "Zlacze", "Plytka"]
+    return [
+        f"{i:>3}. {rng.choice(goods)} {rng.randint(100, 999)}-{rng.randint(10, 99)}"
+        f"   {rng.randint(1, 500)} szt   {polish_number(rng.uniform(1, 900), 2)}"
+        for i in range(1, count + 1)
+    ]
+
+
+def generate_corpus(folder, count=100, pages=2, lines_per_page=45, seed=0):
+    """
+    Generate synthetic Z* attachments and matching 9* invoices
+
+    VAT and package numbers are on the first page, weight and net value on
+    the last one, like in real attachments.
+
+    :param folder: Output folder (created if missing)
+    :param count: Number of attachment/invoice pairs
+    :param pages: Pages per attachment
+    :param lines_per_page: Filler lines per page
+    :param seed: Random seed, same seed gives the same corpus
+    """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for idx in range(count):
+        invoice_no = f"9{rng.randint(100000000, 999999999)}"
+        package = f"{rng.randint(0, 999999999999):012d}"
+        weight = rng.uniform(0.1, 2500)
+        net_value = rng.uniform(10, 250000)
+
+        attachment = [item_lines(rng, lines_per_page) for _ in range(pages)]
+        attachment[0][:0] = [
+            "ZALACZNIK DO FAKTURY",
+            f"VAT nr: {invoice_no}",
+            f"Nr paczki : {package}",
+            f"Data wystawienia: 2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        ]
+        attachment[-1] += [
+            f"Waga Netto {polish_number(weight, 3)} kg",
+            f"Wartosc Netto {polish_number(net_value, 2)} PLN",
+        ]
+        write_pdf(os.path.join(folder, f"Z{idx:06d}.pdf"), attachment)
+
+        invoice = [[f"FAKTURA VAT nr {invoice_no}", f"Paczka: {package}"] + item_lines(rng, 20)]
+        write_pdf(os.path.join(folder, f"00{invoice_no}.pdf"), invoice)
+
+
+FIELD_NAMES = ("VAT", "Paczka", "Waga", "Wartość")
+
+
+def time_extraction(paths, fast=True, engine="pdfplumber", repeat=1):
+    """
+    Extract all files and measure the total time
+
+    :param paths: PDF paths
+    :param fast: Use the raw text fast path
+    :param engine: Engine name passed to extract_vat_package_weight
+    :param repeat: Number of passes over the files
+    """
+    results = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            results[path] = extract_vat_package_weight(path, fast, engine)
+    elapsed = time.perf_counter() - start
+    return elapsed / repeat, results
+
+
+def compare_fast_path(paths, repeat=1):
+    """
+    Compare the fast raw text path against full layout extraction
+
+    :param paths: PDF paths
+    :param repeat: Number of passes over the files
+    """
+    print("\n⏱️  SZYBKI ODCZYT vs PEŁNY UKŁAD")
+    print_separator()
+
+    full_time, full_results = time_extraction(paths, fast=False, repeat=repeat)
+    fast_time, fast_results = time_extraction(paths, fast=True, repeat=repeat)
+
+    mismatches = [p for p in paths if full_results[p] != fast_results[p]]
+    count = len(paths)
+
+    print(f"  Pliki          : {count}")
+    print(f"  Pełny układ    : {full_time:.3f} s ({count / full_time:.1f} plików/s)")
+    print(f"  Szybki odczyt  : {fast_time:.3f} s ({count / fast_time:.1f} plików/s)")
+    print(f"  Przyspieszenie : x{full_time / fast_time:.1f}")
+    print(f"  Zgodność       : {count - len(mismatches)}/{count}")
+    for path in mismatches:
+        print(f"  ✗ {os.path.basename(path)}: {full_results[path]} != {fast_results[path]}")
+    print_separator()
+
+
+def compare_engines(paths, repeat=1, reference="pdfplumber"):
+    """
+    Compare throughput and field-level agreement of PDF engines
+
+    :param paths: PDF paths
+    :param repeat: Number of passes over the files
+    :param reference: Engine whose results are treated as correct
+    """
+    print("\n⚙️  PORÓWNANIE SILNIKÓW PDF")
+    print_separator()
+
+    count = len(paths)
+    timings = {}
+    results = {}
+    for engine in [*PDF_ENGINES, "auto"]:
+        timings[engine], results[engine] = time_extraction(paths, engine=engine, repeat=repeat)
+
+    header = "".join(f"{name:>9}" for name in FIELD_NAMES)
+    print(f"  {'Silnik':<12}{'plików/s':>10}{header}")
+    for engine, elapsed in timings.items():
+        agreement = []
+        for field_idx in range(len(FIELD_NAMES)):
+            same = sum(
+                1 for p in paths
+                if results[engine][p][field_idx] == results[reference][p][field_idx]
+            )
+            agreement.append(f"{same}/{count}")
+        cells = "".join(f"{a:>9}" for a in agreement)
+        print(f"  {engine:<12}{count / elapsed:>10.1f}{cells}")
+
+    print(f"\n  Zgodność pól liczona względem: {reference}")
+    print_separator()
+
+
+def percentile(values, pct):
+    """
+    Percentile by nearest rank
+
+    :param values: Sorted list of numbers
+    :param pct: Percentile 0-100
+    """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def measure_io(paths, io_mode, engine="pdfplumber", fast=True):
+    """
+    Extract all pages of every file and return (seconds, peak RSS in MB)
+
+    Meant to run in a fresh spawned process, so the peak RSS is the one of
+    a single worker reading these files.
+
+    :param paths: PDF paths
+    :param io_mode: Value for main.PDF_IO ("mmap" or "file")
+    :param engine: Engine passed to extract_vat_package_weight
+    :param fast: Use the raw text fast path
+    """
+    import main
+
+    main.PDF_IO = io_mode
+    start = time.perf_counter()
+    for path in paths:
+        extract_vat_package_weight(path, fast, engine, max_pages=None)
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def compare_io(paths, engines=("pdfplumber", "pypdf"), fast=True):
+    """
+    Compare memory-mapped and plain file input, each in a fresh worker process
+
+    :param paths: PDF paths
+    :param engines: Engines to measure
+    :param fast: Use the raw text fast path
+    """
+    print("\n🧠 ODCZYT PLIKÓW: MMAP vs PLIK")
+    print_separator()
+    context = multiprocessing.get_context("spawn")
+    print(f"  {'Silnik':<12}{'Tryb':<6}{'Czas [s]':>10}{'plików/s':>10}{'RSS [MB]':>10}")
+    for engine in engines:
+        for io_mode in ("file", "mmap"):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                elapsed, rss = executor.submit(measure_io, paths, io_mode, engine, fast).result()
+            rss_cell = f"{rss:>10.1f}" if rss is not None else f"{'-':>10}"
+            print(f"  {engine:<12}{io_mode:<6}{elapsed:>10.3f}{len(paths) / elapsed:>10.1f}{rss_cell}")
+    print_separator()
+
+
+def run_pipeline(folder, engine="pdfplumber", fast=True):
+    """
+    Run discovery -> extract -> Excel -> summary once and measure every stage
+
+    :param folder: Folder with Z* files
+    :param engine: Engine passed to extract_vat_package_weight
+    :param fast: Use the raw text fast path
+    """
+    stages = {}
+
+    start = time.perf_counter()
+    z_files, _ = get_files_paths(folder)
+    stages["discovery"] = time.perf_counter() - start
+
+    latencies = []
+    rows = []
+    start = time.perf_counter()
+    for file in z_files:
+        file_start = time.perf_counter()
+        vat, package, weight, net_value = extract_vat_package_weight(
+            os.path.join(folder, file), fast, engine
+        )
+        latencies.append(time.perf_counter() - file_start)
+        rows.append((vat, weight, package, net_value))
+    stages["extract"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sink = create_sink(os.path.join(folder, "_benchmark.xlsx"))
+    for row in rows:
+        sink.write(row)
+    sink.close()
+    stages["excel"] = time.perf_counter() - start
+    os.remove(sink.file_name)
+
+    start = time.perf_counter()
+    stats = RowStats()
+    for row in rows:
+        stats.add(row)
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary(stats)
+    stages["summary"] = time.perf_counter() - start
+
+    pages = sum(len(PdfReader(os.path.join(folder, f)).pages) for f in z_files)
+    total = sum(stages.values())
+    latencies.sort()
+    return {
+        "files": len(z_files),
+        "pages": pages,
+        "files_per_s": len(z_files) / total if total else 0.0,
+        "pages_per_s": pages / total if total else 0.0,
+        "stages_s": stages,
+        "extract_p50_ms": percentile(latencies, 50) * 1000,
+        "extract_p90_ms": percentile(latencies, 90) * 1000,
+        "extract_p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# Metric name, label, True when higher is better
+REPORT_METRICS = (
+    ("files_per_s", "Pliki/s", True),
+    ("pages_per_s", "Strony/s", True),
+    ("extract_p50_ms", "Ekstrakcja p50 [ms]", False),
+    ("extract_p90_ms", "Ekstrakcja p90 [ms]", False),
+    ("extract_p99_ms", "Ekstrakcja p99 [ms]", False),
+    ("peak_rss_mb", "Szczyt RSS [MB]", False),
+)
+
+
+def print_report(result, baseline=None, max_regression=10.0):
+    """
+    Print benchmark result, compared to a baseline when given
+
+    Returns False when any metric is worse than the baseline by more than
+    ``max_regression`` percent.
+
+    :param result: Dict returned by run_pipeline
+    :param baseline: Optional earlier result
+    :param max_regression: Allowed regression in percent
+    """
+    print("\n📈 BENCHMARK POTOKU")
+    print_separator()
+    print(f"  Pliki / strony : {result['files']} / {result['pages']}")
+    for stage, seconds in result["stages_s"].items():
+        print(f"  Etap {stage:<10}: {seconds:.3f} s")
+    print()
+
+    ok = True
+    for key, label, higher_is_better in REPORT_METRICS:
+        value = result.get(key)
+        if value is None:
+            continue
+        line = f"  {label:<22}: {value:10.2f}"
+        old = (baseline or {}).get(key)
+        if old:
+            change = (value - old) / old * 100
+            regression = -change if higher_is_better else change
+            marker = "✗" if regression > max_regression else "✓"
+            ok = ok and regression <= max_regression
+            line += f"   (baza {old:.2f}, {change:+.1f}% {marker})"
+        print(line)
+    print_separator()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarki ekstrakcji plików Z*")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="wygeneruj syntetyczne pliki Z* i 9*")
+    generate.add_argument("folder")
+    generate.add_argument("--count", type=int, default=100, help="liczba par Z*/9* (domyślnie 100)")
+    generate.add_argument("--pages", type=int, default=2, help="strony na załącznik (domyślnie 2)")
+    generate.add_argument("--seed", type=int, default=0, help="ziarno losowania (domyślnie 0)")
+
+    run = commands.add_parser("run", help="zmierz cały potok: wyszukanie, ekstrakcja, Excel, podsumowanie")
+    run.add_argument("folder")
+    run.add_argument("--engine", choices=[*PDF_ENGINES, "auto"], default="pdfplumber")
+    run.add_argument("--full-layout", action="store_true", help="bez szybkiego odczytu tekstu")
+    run.add_argument("--baseline", help="plik JSON z wynikiem bazowym do porównania")
+    run.add_argument("--save-baseline", help="zapisz wynik jako nowy plik bazowy")
+    run.add_argument(
+        "--max-regression", type=float, default=10.0,
+        help="dopuszczalne pogorszenie względem bazy w %% (domyślnie 10)"
+    )
+
+    compare = commands.add_parser("compare", help="porównaj szybki odczyt i silniki PDF")
+    compare.add_argument("folder", help="folder z plikami Z*")
+    compare.add_argument("--repeat", type=int, default=1, help="liczba powtórzeń (domyślnie 1)")
+    compare.add_argument(
+        "--compare", choices=["fast", "engines", "all"], default="all",
+        help="fast = szybki odczyt vs pełny układ, engines = silniki PDF (domyślnie all)"
+    )
+    memory = commands.add_parser(
+        "memory", help="porównaj czas i szczytowe RSS odczytu przez mmap i zwykły plik"
+    )
+    memory.add_argument("folder", help="folder z plikami Z* (najlepiej wielostronicowymi)")
+    memory.add_argument("--full-layout", action="store_true", help="bez szybkiego odczytu tekstu")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate_corpus(args.folder, args.count, args.pages, seed=args.seed)
+        print(f"✓ Wygenerowano {args.count} załączników Z* i faktur 9* w {args.folder}")
+        return
+
+    paths = sorted(
+        os.path.join(args.folder, f) for f in os.listdir(args.folder) if is_attachment(f)
+    )
+    if not paths:
+        print(f"⚠ Brak plików Z* w {args.folder}")
+        sys.exit(1)
+
+    if args.command == "run":
+        result = run_pipeline(args.folder, args.engine, fast=not args.full_layout)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        ok = print_report(result, baseline, args.max_regression)
+        if args.save_baseline:
+            with open(args.save_baseline, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+            print(f"  ✓ Zapisano bazę: {args.save_baseline}")
+        sys.exit(0 if ok else 1)
+
+    if args.command == "memory":
+        compare_io(paths, fast=not args.full_layout)
+        return
+
+    if args.compare in ("fast", "all"):
+        compare_fast_path(paths, args.repeat)
+    if args.compare in ("engines", "all"):
+        compare_engines(paths, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
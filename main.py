@@ -3,10 +3,43 @@ import os
 import sys
 import time
 import ctypes
+import sqlite3
+import hashlib
+import mmap
+import argparse
+import csv
+import json
+import heapq
+import math
+import array
+import statistics
+import cProfile
+import asyncio
+import contextlib
+import collections
+import shlex
+import tempfile
+import socket
+import signal
+import functools
+import threading
 import subprocess
-import pdfplumber
-import pygetwindow as gw
-from openpyxl import Workbook
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+import glob
+import itertools
+
+# pdfplumber, pdfminer, pypdf, openpyxl and pygetwindow are imported inside the
+# functions using them, so --help and --dry-run start without loading them.
+# LazyPages, raw_text_device_class and page_digest use pdfplumber/pdfminer
+# internals; requirements.txt pins the versions they were tested with.
+
+# Bump whenever extract_vat_package_weight changes what it returns, so cached
+# results from an older parser are not reused.
+PARSER_VERSION = 6
+CACHE_FILE = ".fv_cache.sqlite"
+CACHE_SCHEMA = 2
 
 
 def get_sumatra_path():
@@ -32,6 +65,10 @@ def force_window_height():
     """
     Set console window in 0,0 posiotion and resize it to 800 weight
     """
+    if os.name != "nt":
+        return
+    import pygetwindow as gw
+
     time.sleep(0.1)
     win = gw.getActiveWindow()
     if win:
@@ -65,16 +102,188 @@ def print_separator(char="─", length=62):
     print(char * length)
 
 
-def get_files_paths(current_dir):
+ATTACHMENT = "attachment"
+INVOICE = "invoice"
+# (kind, name prefixes) checked in order, the first match wins; see set_prefix_rules
+PREFIX_RULES = [(ATTACHMENT, ("Z",)), (INVOICE, ("9", "009"))]
+
+
+def set_prefix_rules(attachment=None, invoice=None):
+    """
+    Replace file name prefixes used to recognise attachments and invoices
+
+    :param attachment: Prefixes of attachment PDFs (None keeps the current ones)
+    :param invoice: Prefixes of invoice PDFs (None keeps the current ones)
+    """
+    rules = dict(PREFIX_RULES)
+    if attachment:
+        rules[ATTACHMENT] = tuple(attachment)
+    if invoice:
+        rules[INVOICE] = tuple(invoice)
+    PREFIX_RULES[:] = rules.items()
+
+
+def classify(file_name):
+    """
+    Return ATTACHMENT, INVOICE or None for a file name
+
+    :param file_name: File name
+    """
+    if not file_name.lower().endswith(".pdf"):
+        return None
+    for kind, prefixes in PREFIX_RULES:
+        if file_name.startswith(prefixes):
+            return kind
+    return None
+
+
+def is_attachment(file_name):
+    """
+    Check if file is a Z* attachment PDF
+
+    :param file_name: File name
+    """
+    return classify(file_name) == ATTACHMENT
+
+
+def is_invoice(file_name):
+    """
+    Check if file is a 9* invoice PDF
+
+    :param file_name: File name
+    """
+    return classify(file_name) == INVOICE
+
+
+class FileIndex:
+    """
+    Classified PDF files of one directory with their size and mtime
+
+    Built from a single scandir pass; each name is classified once and
+    kept in a sorted list per kind. On Windows (and most network shares)
+    scandir returns the stat data with the listing, so no extra request
+    per file is needed.
+    """
+
+    def __init__(self):
+        self.kinds = {kind: [] for kind, _ in PREFIX_RULES}
+        self.stats = {}
+
+    @classmethod
+    def scan(cls, directory, stat=True):
+        """
+        Index Z* and 9* PDF files of a directory
+
+        :param directory: Directory to list
+        :param stat: Keep size and mtime; on Linux this costs one stat call
+            per file, so listings that only need names pass False
+        """
+        index = cls()
+        with os.scandir(directory) as listing:
+            for entry in listing:
+                kind = classify(entry.name)
+                if kind is None:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    if stat:
+                        st = entry.stat()
+                        index.stats[entry.name] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+                index.kinds[kind].append(entry.name)
+        for names in index.kinds.values():
+            names.sort()
+        return index
+
+    def names(self, kind):
+        """
+        Sorted file names of one kind
+
+        :param kind: ATTACHMENT or INVOICE
+        """
+        return self.kinds[kind]
+
+    def snapshot(self):
+        """Return {name: (size, mtime)} for change detection"""
+        return dict(self.stats)
+
+
+def get_files_paths(current_dir, stats=None):
     """
     Get Z* (attachments) and 9* (invoices) PDF files
 
     :param current_dir: Current working directory
+    :param stats: Optional dict receiving {name: (size, mtime)} from the
+        listing, for ExtractionCache.digest
+    """
+    index = FileIndex.scan(current_dir, stat=stats is not None)
+    if stats is not None:
+        stats.update(index.stats)
+    return index.names(ATTACHMENT), index.names(INVOICE)
+
+
+def iter_inputs(inputs, recursive=False, stats=None):
+    """
+    Yield Z* and 9* PDF paths from directories and glob patterns
+
+    Paths are produced directory by directory (sorted by name inside each
+    one), so processing can start before all inputs are listed. A path
+    matched by several inputs is yielded once. Directories are listed with
+    FileIndex.
+
+    :param inputs: Directories or glob patterns ("**" matches subdirectories)
+    :param recursive: Also search subdirectories of directory inputs
+    :param stats: Optional dict receiving {path: (size, mtime)} of Z* files
+        in listed directories, for ExtractionCache.digest
+    """
+    seen = set()
+
+    def emit(directory, names, found=None):
+        for name in sorted(names):
+            path = os.path.abspath(os.path.join(directory, name))
+            if path not in seen:
+                seen.add(path)
+                if found and name in found and is_attachment(name):
+                    stats[path] = found[name]
+                yield path
+
+    def emit_directory(directory):
+        index = FileIndex.scan(directory, stat=stats is not None)
+        names = index.names(ATTACHMENT) + index.names(INVOICE)
+        return emit(directory, names, index.stats if stats is not None else None)
+
+    for item in inputs:
+        if os.path.isdir(item):
+            if recursive:
+                for directory, subdirs, _ in os.walk(item):
+                    subdirs.sort()
+                    yield from emit_directory(directory)
+            else:
+                yield from emit_directory(item)
+        else:
+            for path in sorted(glob.iglob(item, recursive=True)):
+                name = os.path.basename(path)
+                if classify(name) is not None and os.path.isfile(path):
+                    yield from emit(os.path.dirname(path), [name])
+
+
+def split_invoices(paths, invoices, on_invoice=None):
+    """
+    Pass Z* paths through and collect 9* paths into ``invoices``
+
+    :param paths: Iterable of PDF paths
+    :param invoices: List receiving invoice paths
+    :param on_invoice: Optional callback called with each invoice path
     """
-    files = os.listdir(current_dir)
-    z_files = sorted([f for f in files if f.startswith("Z") and f.lower().endswith(".pdf")])
-    nine_files = sorted([f for f in files if f.startswith(("9", "009")) and f.lower().endswith(".pdf")])
-    return z_files, nine_files
+    for path in paths:
+        if is_attachment(os.path.basename(path)):
+            yield path
+        else:
+            invoices.append(path)
+            if on_invoice is not None:
+                on_invoice(path)
 
 
 def print_founded_files(z_files, nine_files, col_width=30):
@@ -105,233 +314,4131 @@ def print_founded_files(z_files, nine_files, col_width=30):
         sys.exit(1)
 
 
-def extract_vat_package_weight(pdf_path):
+@functools.lru_cache(maxsize=None)
+def raw_text_device_class():
     """
-    Extract VAT, package number, and weight from Z* PDFs
+    Build the RawTextDevice class on first use, so pdfminer is imported lazily
+    """
+    from pdfminer.pdfdevice import PDFDevice
 
-    :param pdf_path: Direct path to pdf file
+    class RawTextDevice(PDFDevice):
+        """
+        pdfminer device collecting text in content-stream order
+
+        Unlike pdfplumber it builds no per-character layout objects, which makes
+        it an order of magnitude cheaper than ``page.extract_text()``. A newline
+        is emitted when the baseline moves and a space when a run starts at a new
+        position on the same line.
+        """
+
+        def __init__(self, rsrcmgr):
+            super().__init__(rsrcmgr)
+            self.parts = []
+            self.last_pos = None
+
+        def render_string(self, textstate, seq, ncs, graphicstate):
+            matrix = textstate.matrix
+            x, y = textstate.linematrix
+            pos = (matrix[4] + matrix[0] * x + matrix[2] * y, matrix[5] + matrix[1] * x + matrix[3] * y)
+            if self.last_pos is not None:
+                if abs(pos[1] - self.last_pos[1]) > 1:
+                    self.parts.append("\n")
+                elif abs(pos[0] - self.last_pos[0]) > 1:
+                    self.parts.append(" ")
+            self.last_pos = pos
+
+            font = textstate.font
+            for obj in seq:
+                if isinstance(obj, bytes):
+                    for cid in font.decode(obj):
+                        try:
+                            self.parts.append(font.to_unichr(cid))
+                        except Exception:
+                            pass
+                elif obj < -200:
+                    # Large TJ adjustment is how many generators encode a space
+                    self.parts.append(" ")
+
+        def get_text(self):
+            return "".join(self.parts)
+
+    return RawTextDevice
+
+
+def raw_page_text(page, rsrcmgr):
+    """
+    Get page text without layout analysis
+
+    :param page: pdfplumber page
+    :param rsrcmgr: Shared pdfminer PDFResourceManager (caches fonts)
+    """
+    from pdfminer.pdfinterp import PDFPageInterpreter
+
+    device = raw_text_device_class()(rsrcmgr)
+    PDFPageInterpreter(rsrcmgr, device).process_page(page.page_obj)
+    return device.get_text()
+
+
+def to_number(value):
+    """
+    Convert Polish formatted number ("1 234,50") to float
+
+    Returns the cleaned string when it still is not a number, so the raw
+    value ends up in the workbook instead of being lost.
+
+    :param value: Matched text
     """
-    vat_number = None
-    package = None
-    weight = None
-    net_value = None
+    clean_str = re.sub(r'[^\d,]', '', value)
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-
-                # Extract VAT number
-                if "VAT nr:" in text and vat_number is None:
-                    start = text.find("VAT nr:") + len("VAT nr:") + 1
-                    vat_number = text[start:start + 10].strip()
-
-                # Extract package number
-                if "Nr paczki :" in text and package is None:
-                    start = text.find("Nr paczki :") + len("Nr paczki :") + 1
-                    package = text[start:start + 12].strip()
-
-                # Extract weight
-                if "Waga Netto" in text and weight is None:
-                    start = text.find("Waga Netto") + len("Waga Netto")
-                    weight_str = text[start:start + 15].strip()
-                    clean_str = re.sub(r'[^\d,]', '', weight_str)
-                    try:
-                        weight = float(clean_str.replace(",", "."))
-                    except ValueError:
-                        weight = clean_str
-
-                # Extract weight
-                if "Wartosc Netto" in text and net_value is None:
-                    start = text.find("Wartosc Netto") + len("Wartosc Netto")
-                    net_value_str = text[start:start + 15].strip()
-                    clean_str = re.sub(r'[^\d,]', '', net_value_str)
-                    try:
-                        net_value = float(clean_str.replace(",", "."))
-                    except ValueError:
-                        net_value = clean_str
+        return float(clean_str.replace(",", "."))
+    except ValueError:
+        return clean_str
 
-                if vat_number and package and weight and net_value:
-                    break
-    except Exception as e:
-        print(f"  ✗ Błąd w pliku {os.path.basename(pdf_path)}: {e}")
-    return vat_number, package, weight, net_value
 
+# Field name, label regex, regex of gap between label and value, value regex, converter.
+# Add a row here to extract a new field - the scanning loop does not change.
+FIELD_SPECS = (
+    ("vat", r"VAT nr:", r"\s*", r"\S+", str),
+    ("package", r"Nr paczki :", r"\s*", r"\S+", str),
+    ("weight", r"Waga Netto", r"\D{0,15}?", r"\d(?:[\d .\u00a0]*\d)?(?:,\d+)?", to_number),
+    ("net_value", r"Wartosc Netto", r"\D{0,15}?", r"\d(?:[\d .\u00a0]*\d)?(?:,\d+)?", to_number),
+)
 
-def processing_founded_files(files, current_dir, col_width=30):
-    """Process Z* files and extract data"""
-    print("\n\n🔍 PRZETWARZANIE PLIKÓW")
-    print_separator()
+# Older attachments labelled the package number "Paczka:" like the 9* invoices
+LEGACY_FIELD_SPECS = tuple(
+    ("package", r"P\s*aczka:", r"\s*", r"\d+", str) if spec[0] == "package" else spec
+    for spec in FIELD_SPECS
+)
 
-    rows = []
-    print(f"\n  {'Załączniki (Z*)':<{col_width}}")
 
-    for file in files:
-        pdf_path = os.path.join(current_dir, file)
-        vat, package, weight, net_value = extract_vat_package_weight(pdf_path)
+def compile_field_specs(specs):
+    """
+    Compile field specs into one alternation regex with a named group per field
 
-        missing = []
-        if not vat:
-            missing.append("VAT")
-        if not package:
-            missing.append("Paczka")
-        if not weight:
-            missing.append("Waga")
-        if not net_value:
-            missing.append("Wartości netto")
+    :param specs: Sequence of (name, label, gap, value, converter)
+    """
+    pattern = "|".join(
+        f"(?:{label}{gap}(?P<{name}>{value}))" for name, label, gap, value, _ in specs
+    )
+    converters = {name: converter for name, _, _, _, converter in specs}
+    return re.compile(pattern), converters
 
-        if not missing:
-            status = f"✓ {file}"
-        else:
-            missing_str = ", ".join(missing)
-            status = f"✗ {file} (brak: {missing_str})"
 
-        print(f"  {status}")
-        rows.append((vat, weight, package, net_value))
+FIELD_PATTERN, FIELD_CONVERTERS = compile_field_specs(FIELD_SPECS)
 
-    return rows
+LayoutTemplate = collections.namedtuple(
+    "LayoutTemplate", "name fingerprint specs compiled vat_format"
+)
 
 
-def summary(rows):
-    """Print data summary"""
-    print("\n\n📊 PODSUMOWANIE DANYCH")
-    print_separator()
+class TemplateRegistry:
+    """
+    Attachment layouts, each with a page 1 fingerprint and its own field specs
 
-    count_vat = sum(1 for r in rows if r[0] is not None)
-    count_weight = sum(1 for r in rows if r[1] is not None)
-    count_package = sum(1 for r in rows if r[2] is not None)
-    count_net_value = sum(1 for r in rows if r[3] is not None)
-    total = len(rows)
+    The engines read page 1, :meth:`select` picks the first template whose
+    fingerprint matches and only that template's regex is run on the pages.
+    Text matching no fingerprint (e.g. page 1 without the labels) gets a
+    fallback template accepting the labels of every layout. All templates
+    extract the same fields.
 
-    print(f"  Wiersze razem  : {total}")
-    print(f"  Numery VAT     : {count_vat}/{total}")
-    print(f"  Wagi           : {count_weight}/{total}")
-    print(f"  Numery paczek  : {count_package}/{total}")
-    print(f"  Wartości netto : {count_net_value}/{total}")
+    A template may declare the format of its VAT numbers. Rows do not
+    remember their template, so validation flags a VAT number only when
+    every layout declares a format and none of them matches.
+    """
 
-    missing = total - min(count_vat, count_weight, count_package)
-    if missing:
-        print(f"\n  ⚠ {missing} wiersze mają braki — komórki zostawione puste")
-    else:
-        print("  ✓ Wszystkie dane kompletne")
+    def __init__(self):
+        self.templates = []
+        self.fallback = None
+        self.vat_formats = None
 
-    print_separator()
+    def register(self, name, fingerprint, specs, vat_format=None):
+        """
+        Add a layout; templates registered earlier are tried first
 
+        :param name: Short layout name, part of the LAYOUT_INDEX key
+        :param fingerprint: Regex found on page 1 of this layout only
+        :param specs: Field specs (see FIELD_SPECS)
+        :param vat_format: Regex every VAT number of this layout fully matches,
+            None = not checked
+        """
+        if self.templates and [spec[0] for spec in specs] != self.field_names():
+            raise ValueError(f"Szablon {name}: inne pola niż {self.field_names()}")
+        self.templates.append(LayoutTemplate(
+            name, re.compile(fingerprint), specs, compile_field_specs(specs),
+            re.compile(vat_format) if vat_format else None
+        ))
+        self.fallback = self.merge()
+        formats = [template.vat_format for template in self.templates]
+        self.vat_formats = None if None in formats else formats
 
-def excel_create(rows):
-    """Create Excel file with extracted data"""
-    print("\n💾 TWORZENIE PLIKU EXCEL")
-    print_separator()
+    def field_names(self):
+        """Names of the fields every template extracts"""
+        return [spec[0] for spec in self.templates[0].specs]
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Dane Faktur"
+    def merge(self):
+        """Template whose label of every field matches the label of any layout"""
+        specs = []
+        for idx, name in enumerate(self.field_names()):
+            variants = []
+            for template in self.templates:
+                _, label, gap, _, _ = template.specs[idx]
+                if f"{label}{gap}" not in variants:
+                    variants.append(f"{label}{gap}")
+            _, _, _, value, converter = self.templates[0].specs[idx]
+            specs.append((name, f"(?:{'|'.join(variants)})", "", value, converter))
+        return LayoutTemplate("*", None, tuple(specs), compile_field_specs(specs), None)
 
-    ws.append(["FV", "Waga", "Paczka", "Wartość"])
+    def valid_vat(self, vat):
+        """
+        False only when every layout declares a VAT format and ``vat`` matches none
 
-    row_count = 0
-    for vat, weight, package, net_value in rows:
-        fv_cell = f"{vat}" if vat else None
-        ws.append([fv_cell, weight, package, net_value])
-        row_count += 1
+        :param vat: Extracted VAT number
+        """
+        if self.vat_formats is None:
+            return True
+        return any(vat_format.fullmatch(vat) for vat_format in self.vat_formats)
 
-    file_name = "fv_waga.xlsx"
-    wb.save(file_name)
+    def select(self, text):
+        """
+        Template for a document with page 1 ``text``
 
-    print(f"  ✓ Plik zapisany : {file_name}")
-    print(f"  ✓ Dodano wierszy: {row_count}")
-    print_separator()
+        :param text: Text of the first page
+        """
+        for template in self.templates:
+            if template.fingerprint.search(text):
+                return template
+        return self.fallback
 
-    return file_name
 
+# Newest layout first; a new supplier format is one more register() call.
+# VAT numbers in the archive have 8 (older attachments) or 10 digits.
+ATTACHMENT_TEMPLATES = TemplateRegistry()
+ATTACHMENT_TEMPLATES.register("nr-paczki", r"Nr paczki :", FIELD_SPECS, r"\d{8}|\d{10}")
+ATTACHMENT_TEMPLATES.register("paczka", r"\bP\s*aczka:", LEGACY_FIELD_SPECS, r"\d{8}|\d{10}")
 
-def print_invoices_sequential(invoice_files, current_dir):
-    print("\n\n🖨️  DRUKOWANIE FAKTUR")
-    print_separator()
+# 9* invoices only carry the package number ("Paczka:" in older layouts too)
+INVOICE_FIELD_SPECS = (
+    ("invoice_package", r"P\s*aczka:", r"\s*", r"\d+", str),
+)
+INVOICE_FIELDS = compile_field_specs(INVOICE_FIELD_SPECS)
 
-    try:
-        sumatra_exe = get_sumatra_path()
-    except Exception as e:
-        print(f"  ❌ {e}")
+
+def parse_fields(text, fields, compiled=None):
+    """
+    Fill still missing fields from page text in a single regex pass
+
+    The first occurrence of every label wins, like before.
+
+    :param text: Page text
+    :param fields: Dict keyed by field spec names (updated in place)
+    :param compiled: (pattern, converters) from compile_field_specs, default FIELD_SPECS
+    """
+    pattern, converters = compiled or (FIELD_PATTERN, FIELD_CONVERTERS)
+    missing = sum(1 for value in fields.values() if value is None)
+    if not missing:
         return
+    for match in pattern.finditer(text):
+        name = match.lastgroup
+        if fields[name] is None:
+            fields[name] = converters[name](match.group(name))
+            missing -= 1
+            if not missing:
+                return
+
+
+def add_time(timings, key, start):
+    """
+    Add time elapsed since ``start`` to ``timings[key]``
+
+    :param timings: Dict of seconds per stage, or None to skip
+    :param key: Stage name
+    :param start: Value of time.perf_counter() at stage start
+    """
+    if timings is not None:
+        timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+
+
+def timed_parse(text, fields, timings, compiled=None):
+    """
+    parse_fields() with its time added to ``timings["parse"]``
+
+    :param text: Page text
+    :param fields: Dict of fields (updated in place)
+    :param timings: Dict of seconds per stage, or None
+    :param compiled: (pattern, converters) passed to parse_fields
+    """
+    start = time.perf_counter()
+    parse_fields(text, fields, compiled)
+    add_time(timings, "parse", start)
+
+
+def fields_complete(fields):
+    """
+    Check if every field was found; 0.0 is a valid value, only None is missing
 
-    for idx, filename in enumerate(invoice_files, 1):
-        pdf_path = os.path.join(current_dir, filename)
-        print(f"  [{idx}/{len(invoice_files)}] Drukuję: {filename}...", end=" ", flush=True)
+    :param fields: Dict of fields
+    """
+    return all(value is not None for value in fields.values())
+
+
+def layout_key(metadata, width, height):
+    """
+    Identify attachment layout by PDF producer/creator and page size
+
+    :param metadata: PDF document info dict
+    :param width: Width of the first page
+    :param height: Height of the first page
+    """
+    metadata = metadata or {}
+    return f"{metadata.get('Producer', '')}|{metadata.get('Creator', '')}|{round(width)}x{round(height)}"
+
+
+class LayoutIndex:
+    """
+    Learned page positions of each field per attachment layout
+
+    Positions in the first half of a document are counted from the start,
+    the rest from the end (-1 = last page), so a field that is always on the
+    last page is found there regardless of the page count.
+    """
+
+    def __init__(self):
+        self.positions = {}
+
+    def record(self, layout, field, page_idx, page_count):
+        """
+        Remember that ``field`` was found on page ``page_idx``
+
+        :param layout: Layout key
+        :param field: Field name
+        :param page_idx: Zero based page index
+        :param page_count: Number of pages in the document
+        """
+        position = page_idx if page_idx < page_count / 2 else page_idx - page_count
+        counts = self.positions.setdefault(layout, {}).setdefault(field, {})
+        counts[position] = counts.get(position, 0) + 1
+
+    def page_order(self, layout, page_count, missing):
+        """
+        Page indexes to read: learned pages of missing fields first, then the rest
+
+        The rest alternates from both ends (0, -1, 1, -2, ...), so with a page
+        budget a layout not learned yet still gets its last pages read, where
+        the totals usually are.
+
+        :param layout: Layout key
+        :param page_count: Number of pages in the document
+        :param missing: Names of fields still missing
+        """
+        order = []
+        learned = self.positions.get(layout, {})
+        for field in missing:
+            counts = learned.get(field)
+            if not counts:
+                continue
+            position = max(counts, key=counts.get)
+            idx = position % page_count if -page_count <= position < page_count else None
+            if idx is not None and idx not in order:
+                order.append(idx)
+        seen = set(order)
+        for idx in range(page_count):
+            idx = idx // 2 if idx % 2 == 0 else page_count - 1 - idx // 2
+            if idx not in seen:
+                order.append(idx)
+        return order
+
+
+# Each process (including pool workers) learns its own index as files go by
+LAYOUT_INDEX = LayoutIndex()
+DEFAULT_MAX_PAGES = 0
+
+
+class PageBudget:
+    """
+    Page reads allowed in each pass over one file
+
+    Every pass (raw text, full layout, each engine of "auto") gets its own
+    ``pages`` reads, so a fallback pass is not left with whatever the pass
+    before it did not use; the page 1 read for the layout fingerprint counts
+    in the pass doing it. ``cut`` records that a pass stopped with pages
+    left unread.
+    """
+
+    def __init__(self, pages=None):
+        self.pages = pages or None
+        self.left = self.pages
+        self.cut = False
+
+    def new_pass(self):
+        """Start the next pass with the full budget"""
+        self.left = self.pages
+
+    def take(self):
+        """Use up one page read, False when none is left"""
+        if self.left is None:
+            return True
+        if self.left <= 0:
+            self.cut = True
+            return False
+        self.left -= 1
+        return True
+
+
+def scan_pages(page_count, read_text, fields, layout, budget, timings, stage, compiled=None):
+    """
+    Read pages in learned order until all fields are found or the pass budget runs out
+
+    :param page_count: Number of pages in the document
+    :param read_text: Function page index -> page text
+    :param fields: Dict of fields (updated in place)
+    :param layout: Layout key for LAYOUT_INDEX
+    :param budget: PageBudget of the file, started anew for this pass, None = no limit
+    :param timings: Optional dict of seconds per stage
+    :param stage: Timing key for text reading
+    :param compiled: (pattern, converters) passed to parse_fields, or a
+        TemplateRegistry to pick the template from page 1 first
+    """
+    budget = budget or PageBudget()
+    budget.new_pass()
+    texts = {}
+    if isinstance(compiled, TemplateRegistry):
+        if not budget.take():
+            return
+        start = time.perf_counter()
+        texts[0] = read_text(0) or ""
+        add_time(timings, stage, start)
+        template = compiled.select(texts[0])
+        compiled = template.compiled
+        layout = f"{template.name}|{layout}"
 
+    missing = [name for name, value in fields.items() if value is None]
+    order = LAYOUT_INDEX.page_order(layout, page_count, missing)
+
+    for idx in order:
+        text = texts.pop(idx, None)
+        if text is None:
+            if not budget.take():
+                return
+            start = time.perf_counter()
+            text = read_text(idx) or ""
+            add_time(timings, stage, start)
+        timed_parse(text, fields, timings, compiled)
+
+        for name in missing:
+            if fields[name] is not None:
+                LAYOUT_INDEX.record(layout, name, idx, page_count)
+        missing = [name for name in missing if fields[name] is None]
+        if not missing:
+            return
+
+
+# "mmap" maps input PDFs into memory, "file" reads them through a file object
+PDF_IO = "mmap"
+
+
+@contextlib.contextmanager
+def mapped_pdf(pdf_path):
+    """
+    Open a PDF as a read-only memory map
+
+    The parsers seek and read the mapping directly, so pypdf does not copy
+    the whole file into a BytesIO and pool workers reading the same file
+    share the OS page cache. Files that cannot be mapped (e.g. empty ones)
+    or PDF_IO = "file" fall back to a plain file object.
+
+    :param pdf_path: Direct path to pdf file
+    """
+    with open(pdf_path, "rb") as f:
+        data = None
+        if PDF_IO == "mmap":
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                data = None
+        if data is None:
+            yield f
+            return
+        with data:
+            yield data
+
+
+class LazyPages:
+    """
+    pdfplumber pages created on first access
+
+    ``pdf.pages`` resolves every page object up front; here the page tree is
+    walked only as far as the highest index asked for.
+    """
+
+    def __init__(self, pdf):
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdftypes import resolve1
+
+        self.pdf = pdf
+        self.page_objs = PDFPage.create_pages(pdf.doc)
+        self.pages = []
         try:
-            result = subprocess.run(
-                [sumatra_exe,
-                 "-print-to-default",
-                 "-print-settings", "fit",
-                 "-exit-when-done",
-                 "-reuse-instance",
-                 pdf_path
-                 ],
-                capture_output=True,
-                timeout=60
-            )
+            self.count = int(resolve1(pdf.doc.catalog["Pages"])["Count"])
+        except Exception:
+            self.count = None
 
-            if result.returncode == 0:
-                print("✓")
-            else:
-                print(f"✗ (Kod: {result.returncode})")
+    def __len__(self):
+        if self.count is None:
+            self.load(float("inf"))
+            self.count = len(self.pages)
+        return self.count
 
-            time.sleep(12)
+    def __getitem__(self, idx):
+        self.load(idx)
+        return self.pages[idx]
 
-        except Exception as e:
-            print(f"✗ Błąd: {e}")
+    def load(self, idx):
+        from pdfplumber.page import Page
 
-    print_separator()
-    print("  ✅ Wydruk zakończony")
+        if idx < len(self.pages):
+            return
+        for page_obj in self.page_objs:
+            self.pages.append(
+                Page(self.pdf, page_obj, page_number=len(self.pages) + 1, initial_doctop=0)
+            )
+            if len(self.pages) > idx:
+                break
+        if self.count is not None and idx >= len(self.pages):
+            # /Count of a damaged page tree promised more pages than exist
+            self.count = len(self.pages)
+            raise IndexError(idx)
 
 
-def main():
+def layout_page_text(page):
+    """
+    Get page text with full layout analysis and free the page caches
+
+    :param page: pdfplumber page
+    """
     try:
-        force_window_height()
+        return page.extract_text()
+    finally:
+        page.close()
 
-        current_dir = os.getcwd()
-        time.sleep(1)
 
-        print_header()
+def pdfplumber_engine(pdf_path, fields, fast=True, timings=None, budget=None, compiled=None):
+    """
+    Fill missing fields using pdfplumber
 
-        z_files, nine_files = get_files_paths(current_dir)
-        print_founded_files(z_files, nine_files)
+    The fast path reads raw page text without layout analysis. Only when a
+    field is still missing afterwards are the pages read again with the full
+    ``page.extract_text()`` layout. Pages are opened lazily from a memory
+    map and their layout caches are dropped once read, so memory stays flat
+    on attachments with hundreds of pages.
 
-        rows = processing_founded_files(z_files, current_dir)
-        summary(rows)
+    :param pdf_path: Direct path to pdf file
+    :param fields: Dict with keys vat, package, weight, net_value (updated in place)
+    :param fast: Try the raw text fast path first
+    :param timings: Optional dict filled with seconds spent in open/text/layout/parse
+    :param budget: PageBudget of the file (one budget per pass), None = all pages
+    :param compiled: (pattern, converters) of the fields or a TemplateRegistry
+    """
+    import pdfplumber
+    from pdfminer.pdfinterp import PDFResourceManager
 
-        file_name = excel_create(rows)
+    start = time.perf_counter()
+    with mapped_pdf(pdf_path) as data, pdfplumber.open(data) as pdf:
+        pages = LazyPages(pdf)
+        add_time(timings, "open", start)
+        if not len(pages):
+            return
+        layout = layout_key(pdf.metadata, pages[0].width, pages[0].height)
 
-        print("\n✅ ZAKOŃCZONO POMYŚLNIE")
-        print(f"\n  📁 Plik wynikowy: {file_name}")
-        print_separator()
+        if fast:
+            rsrcmgr = PDFResourceManager(caching=True)
+            scan_pages(
+                len(pages), lambda idx: raw_page_text(pages[idx], rsrcmgr),
+                fields, layout, budget, timings, "text", compiled
+            )
+            if fields_complete(fields):
+                return
 
-        print("\n\nNaciśnij ENTER aby otworzyć plik Excel...")
-        input()
+        scan_pages(
+            len(pages), lambda idx: layout_page_text(pages[idx]),
+            fields, layout, budget, timings, "layout", compiled
+        )
 
-        print("📂 Otwieram plik Excel...")
+
+def pypdf_engine(pdf_path, fields, fast=True, timings=None, budget=None, compiled=None):
+    """
+    Fill missing fields using pypdf plain text extraction
+
+    :param pdf_path: Direct path to pdf file
+    :param fields: Dict with keys vat, package, weight, net_value (updated in place)
+    :param fast: Unused, kept for a common engine signature
+    :param timings: Optional dict filled with seconds spent in open/text/parse
+    :param budget: PageBudget of the file (one budget per pass), None = all pages
+    :param compiled: (pattern, converters) of the fields or a TemplateRegistry
+    """
+    from pypdf import PdfReader
+
+    start = time.perf_counter()
+    with mapped_pdf(pdf_path) as data:
+        reader = PdfReader(data)
+        pages = reader.pages
+        page_count = len(pages)
+        add_time(timings, "open", start)
+        if not page_count:
+            return
+
+        box = pages[0].mediabox
+        layout = layout_key(reader.metadata, float(box.width), float(box.height))
+        scan_pages(
+            page_count, lambda idx: pages[idx].extract_text(),
+            fields, layout, budget, timings, "text", compiled
+        )
+
+
+PDF_ENGINES = {
+    "pdfplumber": pdfplumber_engine,
+    "pypdf": pypdf_engine,
+}
+
+# "auto" runs the engines in this order, later ones only fill what is missing.
+# pdfplumber (raw text, then layout) goes first: its raw text path is the
+# fastest one (see benchmark.py compare), pypdf only reads what it missed.
+AUTO_ENGINE_ORDER = ("pdfplumber", "pypdf")
+
+
+def extract_fields(pdf_path, specs, compiled, fast=True, engine="pdfplumber", timings=None,
+                   max_pages=DEFAULT_MAX_PAGES):
+    """
+    Extract the fields declared by ``specs`` from a PDF
+
+    :param pdf_path: Direct path to pdf file
+    :param specs: Field specs (see FIELD_SPECS)
+    :param compiled: compile_field_specs(specs) or a TemplateRegistry with the same fields
+    :param fast: Try the raw text fast path first (pdfplumber engine)
+    :param engine: Name from PDF_ENGINES or "auto" (pdfplumber, then pypdf for missing fields)
+    :param timings: Optional dict filled with seconds spent per extraction stage
+    :param max_pages: Page reads per pass, None = all pages
+    :return: (fields, truncated); truncated means a field is missing and the
+        page budget stopped a pass before the end of the document
+    """
+    fields = {name: None for name, *_ in specs}
+    engines = AUTO_ENGINE_ORDER if engine == "auto" else (engine,)
+    budget = PageBudget(max_pages)
+
+    for idx, name in enumerate(engines):
         try:
-            os.startfile(file_name)
+            PDF_ENGINES[name](pdf_path, fields, fast, timings, budget, compiled)
         except Exception as e:
-            print(f"❌ Błąd podczas otwierania pliku: {e}")
+            # In auto mode a failing engine just hands over to the next one
+            if idx == len(engines) - 1:
+                print(f"  ✗ Błąd w pliku {os.path.basename(pdf_path)}: {e}", flush=True)
+        if fields_complete(fields):
+            break
+    return fields, budget.cut and not fields_complete(fields)
 
-        # ═══════════════════════════════════════════════════════════════
-        # PRINT INVOICES (9*) - Optional step
-        # ═══════════════════════════════════════════════════════════════
 
-        if nine_files:
-            print("\n" + "═" * 62)
-            print(f"\n📋 Znaleziono {len(nine_files)} faktur (9*)")
+class FieldRow(tuple):
+    """
+    Extracted field values; ``truncated`` marks a row cut short by --max-pages
 
-            response = input("\nCzy wydrukować faktury? [T/N]: ").strip().upper()
+    Such a row is not cached, so a later run reads the pages it skipped.
+    """
 
-            if response in ('T', 'TAK', 'Y', 'YES'):
-                print_invoices_sequential(nine_files, current_dir)
-            else:
-                print("\n  ⏭️  Pominięto drukowanie")
-                print_separator()
-        else:
+    truncated = False
+
+
+def cacheable(result):
+    """
+    Check if an extraction result may be stored in ExtractionCache
+
+    :param result: Tuple (vat, package, weight, net_value)
+    """
+    return any(v is not None for v in result) and not getattr(result, "truncated", False)
+
+
+def extract_vat_package_weight(pdf_path, fast=True, engine="pdfplumber", timings=None,
+                               max_pages=DEFAULT_MAX_PAGES):
+    """
+    Extract VAT, package number, and weight from Z* PDFs
+
+    :param pdf_path: Direct path to pdf file
+    :param fast: Try the raw text fast path first (pdfplumber engine)
+    :param engine: Name from PDF_ENGINES or "auto" (pdfplumber, then pypdf for missing fields)
+    :param timings: Optional dict filled with seconds spent per extraction stage
+    :param max_pages: Page reads per pass, None = all pages
+    """
+    fields, truncated = extract_fields(
+        pdf_path, FIELD_SPECS, ATTACHMENT_TEMPLATES, fast, engine, timings, max_pages
+    )
+    row = FieldRow((fields["vat"], fields["package"], fields["weight"], fields["net_value"]))
+    row.truncated = truncated
+    return row
+
+
+def extract_invoice_package(pdf_path, fast=True, engine="pdfplumber", timings=None,
+                            max_pages=DEFAULT_MAX_PAGES):
+    """
+    Extract package number from a 9* invoice
+
+    :param pdf_path: Direct path to pdf file
+    :param fast: Try the raw text fast path first (pdfplumber engine)
+    :param engine: Name from PDF_ENGINES or "auto"
+    :param timings: Optional dict filled with seconds spent per extraction stage
+    :param max_pages: Page reads per pass, None = all pages
+    """
+    fields, _ = extract_fields(
+        pdf_path, INVOICE_FIELD_SPECS, INVOICE_FIELDS, fast, engine, timings, max_pages
+    )
+    return fields["invoice_package"]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Compute SHA-256 of file content
+
+    :param path: Path to file
+    :param chunk_size: Read block size in bytes
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    On-disk SQLite cache of extract_vat_package_weight results
+
+    Entries are keyed by file content hash, PARSER_VERSION and ``variant``
+    (engine, layout mode and page budget, which all change the output,
+    see cache_variant). Entries not
+    used for ``max_age_days`` are dropped and only the ``max_entries`` most
+    recently used ones are kept. OCR text of scanned pages is kept in a
+    separate table keyed by page hash, see ocr_missing_fields.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_entries=50000, max_age_days=90, rebuild=False,
+                 variant="pdfplumber"):
+        self.path = path
+        self.variant = variant
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.unchanged = 0
+        self.conn = sqlite3.connect(path)
+        if rebuild or self.conn.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA:
+            self.conn.execute("DROP TABLE IF EXISTS extractions")
+            self.conn.execute("DROP TABLE IF EXISTS ocr_pages")
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute(f"PRAGMA user_version = {CACHE_SCHEMA}")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extractions (
+                digest TEXT NOT NULL,
+                parser_version INTEGER NOT NULL,
+                variant TEXT NOT NULL,
+                vat TEXT,
+                package TEXT,
+                weight,
+                net_value,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (digest, parser_version, variant)
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions (last_used)"
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ocr_pages (
+                digest TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def get(self, digest):
+        """
+        Return cached (vat, package, weight, net_value) or None
+
+        :param digest: Content hash of the PDF file
+        """
+        row = self.conn.execute(
+            "SELECT vat, package, weight, net_value FROM extractions "
+            "WHERE digest = ? AND parser_version = ? AND variant = ?",
+            (digest, PARSER_VERSION, self.variant)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute(
+            "UPDATE extractions SET last_used = ? "
+            "WHERE digest = ? AND parser_version = ? AND variant = ?",
+            (time.time(), digest, PARSER_VERSION, self.variant)
+        )
+        return row
+
+    def put(self, digest, result):
+        """
+        Store extraction result
+
+        :param digest: Content hash of the PDF file
+        :param result: Tuple (vat, package, weight, net_value)
+        """
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (digest, PARSER_VERSION, self.variant, *result, now, now)
+        )
+
+    def digest(self, pdf_path, stat=None):
+        """
+        Content hash of a file, reused while its size and mtime are unchanged
+
+        Files unchanged since the last run are not read at all, which
+        matters most on network shares. With ``stat`` from the directory
+        listing the file is not even stat'ed again.
+
+        :param pdf_path: Path to the file
+        :param stat: Optional (size, mtime_ns) from FileIndex, None = stat the file
+        """
+        path = os.path.abspath(pdf_path)
+        if stat is None:
+            st = os.stat(path)
+            stat = st.st_size, st.st_mtime_ns
+        size, mtime = stat
+        row = self.conn.execute(
+            "SELECT digest FROM files WHERE path = ? AND size = ? AND mtime = ?",
+            (path, size, mtime)
+        ).fetchone()
+        if row is not None:
+            self.unchanged += 1
+            self.conn.execute(
+                "UPDATE files SET last_used = ? WHERE path = ?", (time.time(), path)
+            )
+            return row[0]
+        digest = file_digest(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (path, size, mtime, digest, time.time())
+        )
+        return digest
+
+    def put_ocr(self, digest, text):
+        """
+        Store OCR text of one page
+
+        :param digest: Page hash from page_digest
+        :param text: Recognised text
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ocr_pages VALUES (?, ?, ?)", (digest, text, time.time())
+        )
+
+    def evict(self):
+        """Drop stale entries, old parser versions and entries over the size limit"""
+        cutoff = time.time() - self.max_age_days * 86400
+        self.conn.execute("DELETE FROM ocr_pages WHERE created < ?", (cutoff,))
+        self.conn.execute("DELETE FROM files WHERE last_used < ?", (cutoff,))
+        self.conn.execute(
+            "DELETE FROM extractions WHERE last_used < ? OR parser_version != ?",
+            (cutoff, PARSER_VERSION)
+        )
+        self.conn.execute(
+            "DELETE FROM extractions WHERE rowid NOT IN "
+            "(SELECT rowid FROM extractions ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+        self.conn.execute(
+            "DELETE FROM files WHERE rowid NOT IN "
+            "(SELECT rowid FROM files ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def commit(self):
+        """Flush pending writes to disk"""
+        self.conn.commit()
+
+    def close(self):
+        """Evict, commit and close the database"""
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+
+def extract_cached(pdf_path, cache=None, extractor=extract_vat_package_weight, executor=None,
+                   stat=None):
+    """
+    Extract data from one Z* PDF, using the cache when given
+
+    With an ``executor`` (IsolatedPool) the file is read in a worker under
+    its limits; a failed file gives an empty row and is not cached.
+
+    :param pdf_path: Direct path to pdf file
+    :param cache: Optional ExtractionCache
+    :param extractor: Extraction function (pdf_path -> tuple), picklable with an executor
+    :param executor: Optional IsolatedPool
+    :param stat: Optional (size, mtime_ns) from the directory listing
+    """
+    digest = None
+    if cache is not None:
+        digest = cache.digest(pdf_path, stat)
+        cached = cache.get(digest)
+        if cached is not None:
+            return cached
+
+    if executor is None:
+        result = extractor(pdf_path)
+    else:
+        try:
+            result = executor.submit(extractor, pdf_path).result()
+        except ExtractionFailed as e:
+            print(f"  ✗ {os.path.basename(pdf_path)} (błąd: {e})", flush=True)
+            return None, None, None, None
+    if cache is not None and cacheable(result):
+        cache.put(digest, result)
+    return result
+
+
+def ocr_available():
+    """Return None when OCR can run, otherwise the reason why not"""
+    try:
+        import pytesseract
+    except ImportError:
+        return "brak modułu pytesseract"
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return "nie znaleziono programu tesseract"
+    return None
+
+
+def page_digest(page, *params):
+    """
+    Hash of a page's content streams and images, used as OCR cache key
+
+    :param page: pdfplumber page
+    :param params: OCR settings that change the result (language, resolution)
+    """
+    from pdfminer.pdftypes import resolve1
+
+    digest = hashlib.sha256(repr(params).encode())
+    for stream in page.page_obj.contents:
+        digest.update(resolve1(stream).get_data())
+    for image in page.images:
+        digest.update(image["stream"].get_rawdata() or b"")
+    return digest.hexdigest()
+
+
+def ocr_missing_fields(pdf_path, fields, cache_path=None, lang="pol", resolution=300,
+                       max_pages=DEFAULT_MAX_PAGES):
+    """
+    Fill missing fields by OCR of pages without a text layer
+
+    Runs in the OCR pool. Pages with any raw text are skipped. Page texts
+    already in the ``ocr_pages`` table of the cache are read from there; the
+    new ones are returned so the main process can store them. Returns
+    (fields, [(page digest, text), ...]).
+
+    :param pdf_path: Direct path to pdf file
+    :param fields: Dict of fields, missing ones are None
+    :param cache_path: ExtractionCache file or None
+    :param lang: Tesseract language
+    :param resolution: Render resolution in DPI
+    :param max_pages: Page budget, None = all pages
+    """
+    import pdfplumber
+    import pytesseract
+    from pdfminer.pdfinterp import PDFResourceManager
+
+    conn = None
+    if cache_path and os.path.exists(cache_path):
+        conn = sqlite3.connect(cache_path, timeout=10)
+    new_pages = []
+    try:
+        # Path, not mapped_pdf: pypdfium2 renders pages from a file, not an mmap
+        with pdfplumber.open(pdf_path) as pdf:
+            rsrcmgr = PDFResourceManager(caching=True)
+            pages = LazyPages(pdf)
+            for idx in range(min(len(pages), max_pages or len(pages))):
+                page = pages[idx]
+                try:
+                    if raw_page_text(page, rsrcmgr).strip():
+                        continue
+                    digest = page_digest(page, lang, resolution)
+                    row = None
+                    if conn is not None:
+                        row = conn.execute(
+                            "SELECT text FROM ocr_pages WHERE digest = ?", (digest,)
+                        ).fetchone()
+                    if row is not None:
+                        text = row[0]
+                    else:
+                        image = page.to_image(resolution=resolution).original
+                        text = pytesseract.image_to_string(image, lang=lang)
+                        new_pages.append((digest, text))
+                finally:
+                    page.close()
+                parse_fields(text, fields, ATTACHMENT_TEMPLATES.select(text).compiled)
+                if fields_complete(fields):
+                    break
+    finally:
+        if conn is not None:
+            conn.close()
+    return fields, new_pages
+
+
+def ocr_rows(rows, sources, ocr_extractor, workers=1, cache=None, window=256,
+             timeout=None, memory_mb=None, cancel=None):
+    """
+    Pipeline stage filling fields missing after text extraction by OCR
+
+    Only rows with missing fields go to OCR, in a separate IsolatedPool of
+    ``workers`` processes started on first use, so files with a text layer
+    are not slowed down. Rows keep their order; at most ``window`` rows wait
+    behind a file still being recognised. A file exceeding the time or
+    memory limit keeps the fields found without OCR.
+
+    :param rows: Iterable of rows
+    :param sources: Iterable of source paths, one per row in the same order
+    :param ocr_extractor: ocr_missing_fields bound to its options, picklable
+    :param workers: OCR processes
+    :param cache: Optional ExtractionCache receiving OCR page texts
+    :param window: Maximum rows held back
+    :param timeout: Seconds allowed per file, None = no limit
+    :param memory_mb: Memory limit of an OCR process in MB (Unix), None = none
+    :param cancel: Optional threading.Event stopping the stage
+    """
+    pending = collections.deque()
+    executor = None
+
+    def finish(row, source, future):
+        if future is None:
+            return row
+        try:
+            fields, new_pages = wait_result(future, cancel)
+        except ExtractionCancelled:
+            raise
+        except Exception as e:
+            print(f"  ⚠ OCR {os.path.basename(source)}: {e}", flush=True)
+            return row
+        if cache is not None:
+            for digest, text in new_pages:
+                cache.put_ocr(digest, text)
+        vat, package, weight, net_value = (
+            fields["vat"], fields["package"], fields["weight"], fields["net_value"]
+        )
+        print(f"  🔎 OCR {format_status(os.path.basename(source), vat, package, weight, net_value)}",
+              flush=True)
+        return vat, weight, package, net_value
+
+    try:
+        for row, source in zip(rows, sources):
+            future = None
+            if any(value is None for value in row):
+                if executor is None:
+                    executor = IsolatedPool(workers, timeout=timeout, memory_mb=memory_mb)
+                vat, weight, package, net_value = row
+                fields = {"vat": vat, "package": package, "weight": weight, "net_value": net_value}
+                future = executor.submit(ocr_extractor, source, fields)
+            pending.append((row, source, future))
+
+            while pending and (len(pending) > window or pending[0][2] is None
+                               or pending[0][2].done()):
+                yield finish(*pending.popleft())
+
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        if executor is not None:
+            # Rows left over mean the consumer stopped; do not wait for OCR
+            executor.shutdown(wait=not pending)
+
+
+def timed_extract(extractor, pdf_path):
+    """
+    Run extractor and measure it; top-level so it can run in pool workers
+
+    Returns (result, seconds, stage timings).
+
+    :param extractor: Extraction function accepting a ``timings`` keyword
+    :param pdf_path: Direct path to pdf file
+    """
+    timings = {}
+    start = time.perf_counter()
+    result = extractor(pdf_path, timings=timings)
+    return result, time.perf_counter() - start, timings
+
+
+class ExtractionFailed(Exception):
+    """A file could not be extracted: timeout, memory limit or a crashed worker"""
+
+
+class ExtractionCancelled(Exception):
+    """Extraction was stopped through its cancel event"""
+
+
+def check_cancel(cancel):
+    """
+    Raise ExtractionCancelled once ``cancel`` is set
+
+    :param cancel: threading.Event or None
+    """
+    if cancel is not None and cancel.is_set():
+        raise ExtractionCancelled()
+
+
+def wait_result(future, cancel=None):
+    """
+    ``future.result()`` that gives up once ``cancel`` is set
+
+    :param future: Future of a pool task
+    :param cancel: threading.Event or None
+    """
+    while cancel is not None and not future.done():
+        check_cancel(cancel)
+        wait([future], timeout=0.2)
+    return future.result()
+
+
+def isolated_worker(conn, memory_mb=None):
+    """
+    Loop of an IsolatedPool worker process: run tasks received on ``conn``
+
+    :param conn: Pipe end shared with the supervisor
+    :param memory_mb: Address space limit in MB (Unix only)
+    """
+    # Ctrl+C reaches the whole process group; the pool owner stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_mb:
+        try:
+            import resource
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args = task
+        try:
+            conn.send((True, fn(*args), True))
+        except MemoryError:
+            # The heap may be left fragmented; let the supervisor start a fresh worker
+            conn.send((False, f"przekroczono limit pamięci {memory_mb} MB", False))
+            return
+        except Exception as e:
+            conn.send((False, f"{type(e).__name__}: {e}", True))
+
+
+class IsolatedPool:
+    """
+    Long-lived worker processes with a hard time and memory limit per task
+
+    Works like a minimal ProcessPoolExecutor: :meth:`submit` returns a
+    ``concurrent.futures.Future``. Each worker has its own pipe, so the
+    supervisor thread knows which task every worker runs and since when. A
+    task running longer than ``timeout`` seconds gets its worker killed, its
+    future fails with ExtractionFailed and a new worker takes the slot; the
+    other workers keep going. Workers that die (crash, OOM killer) are
+    replaced the same way. The memory limit uses RLIMIT_AS and only applies
+    on Unix. Workers are spawned, not forked: the pool is started from
+    threads (extraction next to the print loop, the supervisor replacing
+    workers) and a forked child could inherit a lock, e.g. of stdout, held
+    by another thread.
+    """
+
+    def __init__(self, workers, timeout=None, memory_mb=None):
+        self.size = max(1, workers)
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.context = multiprocessing.get_context("spawn")
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup_recv, self.wakeup_send = self.context.Pipe(duplex=False)
+        self.slots = [self.spawn() for _ in range(self.size)]
+        self.closed = False
+        self.stopping = False
+        self.killed = 0
+        self.thread = threading.Thread(target=self.supervise, daemon=True)
+        self.thread.start()
+
+    def spawn(self):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(
+            target=isolated_worker, args=(child, self.memory_mb), daemon=True
+        )
+        process.start()
+        child.close()
+        return {"process": process, "conn": parent, "future": None, "start": None}
+
+    def submit(self, fn, *args):
+        """
+        Queue ``fn(*args)`` and return its Future
+
+        :param fn: Picklable function
+        :param args: Picklable arguments
+        """
+        future = Future()
+        with self.lock:
+            self.pending.append((future, fn, args))
+        self.wakeup_send.send(None)
+        return future
+
+    def replace(self, slot, error):
+        """Fail the task of a dead or hung worker and start a new worker"""
+        process = slot["process"]
+        if process.is_alive():
+            process.kill()
+        process.join()
+        slot["conn"].close()
+        if slot["future"] is not None:
+            slot["future"].set_exception(ExtractionFailed(error))
+        self.slots[self.slots.index(slot)] = self.spawn()
+
+    def supervise(self):
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+                for slot in self.slots:
+                    if slot["future"] is None and self.pending:
+                        future, fn, args = self.pending.popleft()
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        slot["future"], slot["start"] = future, time.monotonic()
+                        try:
+                            slot["conn"].send((fn, args))
+                        except OSError:
+                            self.replace(slot, "proces roboczy niedostępny")
+                if self.closed and not self.pending and all(s["future"] is None for s in self.slots):
+                    return
+
+            ready = multiprocessing.connection.wait(
+                [slot["conn"] for slot in self.slots] + [self.wakeup_recv], timeout=0.2
+            )
+            if self.wakeup_recv in ready:
+                while self.wakeup_recv.poll():
+                    self.wakeup_recv.recv()
+
+            for slot in list(self.slots):
+                if slot["conn"] in ready:
+                    try:
+                        ok, value, alive = slot["conn"].recv()
+                    except (EOFError, OSError):
+                        slot["process"].join(timeout=1)
+                        self.replace(slot, f"proces zakończył się (kod {slot['process'].exitcode})")
+                        continue
+                    future, slot["future"] = slot["future"], None
+                    if future is not None:
+                        if ok:
+                            future.set_result(value)
+                        else:
+                            future.set_exception(ExtractionFailed(value))
+                    if not alive:
+                        self.replace(slot, None)
+                elif slot["future"] is not None:
+                    if not slot["process"].is_alive():
+                        self.replace(slot, f"proces zakończył się (kod {slot['process'].exitcode})")
+                    elif self.timeout and time.monotonic() - slot["start"] > self.timeout:
+                        self.killed += 1
+                        self.replace(slot, f"przekroczono limit czasu {self.timeout:g} s")
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers
+
+        :param wait: Finish queued and running tasks first; otherwise
+            cancel them and kill the workers at once
+        """
+        with self.lock:
+            self.closed = True
+            if not wait:
+                self.stopping = True
+                for future, _, _ in self.pending:
+                    future.cancel()
+                self.pending.clear()
+        self.wakeup_send.send(None)
+        self.thread.join()
+        for slot in self.slots:
+            with contextlib.suppress(OSError):
+                slot["conn"].send(None)
+        for slot in self.slots:
+            slot["process"].join(timeout=5 if wait else 0)
+            if slot["process"].is_alive():
+                slot["process"].kill()
+                slot["process"].join()
+            if slot["future"] is not None:
+                slot["future"].set_exception(ExtractionFailed("przerwano"))
+            slot["conn"].close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(wait=exc[0] is None)
+        return False
+
+
+class Timings:
+    """
+    Stage and per-file timing collector
+
+    Stage totals and the slowest files are kept for the console summary.
+    When ``report_path`` is given, every measurement is also written there
+    as one JSON object per line.
+    """
+
+    def __init__(self, report_path=None, keep_slowest=5):
+        self.stages = {}
+        self.file_stages = {}
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+        self.report = open(report_path, "w", encoding="utf-8") if report_path else None
+
+    def emit(self, record):
+        if self.report is not None:
+            self.report.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure a block of code as stage ``name``
+
+        :param name: Stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds):
+        """
+        Add time to a stage
+
+        :param name: Stage name
+        :param seconds: Duration
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.emit({"type": "stage", "name": name, "seconds": round(seconds, 6)})
+
+    def add_file(self, file, seconds, stages=None, cached=False):
+        """
+        Record processing time of one file
+
+        :param file: File name
+        :param seconds: Total duration
+        :param stages: Dict of seconds per extraction stage
+        :param cached: Result came from the cache
+        """
+        stages = stages or {}
+        for name, value in stages.items():
+            self.file_stages[name] = self.file_stages.get(name, 0.0) + value
+        self.emit({
+            "type": "file", "file": file, "seconds": round(seconds, 6), "cached": cached,
+            "stages": {k: round(v, 6) for k, v in stages.items()},
+        })
+        if cached:
+            return
+        entry = (seconds, file, stages)
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def close(self):
+        if self.report is not None:
+            self.report.close()
+
+
+def print_timings(timings):
+    """
+    Print stage times and the slowest files
+
+    :param timings: Timings collector
+    """
+    print("\n⏱️  CZASY ETAPÓW")
+    print_separator()
+    for name, seconds in timings.stages.items():
+        print(f"  {name:<15}: {seconds:8.3f} s")
+
+    if timings.file_stages:
+        print("\n  Ekstrakcja (suma po plikach):")
+        for name, seconds in timings.file_stages.items():
+            print(f"  {name:<15}: {seconds:8.3f} s")
+
+    if timings.slowest:
+        print("\n  Najwolniejsze pliki:")
+        for seconds, file, stages in sorted(timings.slowest, reverse=True):
+            detail = ", ".join(f"{k} {v:.2f}s" for k, v in stages.items())
+            print(f"  • {file:<30} {seconds:6.2f} s  ({detail})")
+    print_separator()
+
+
+def format_status(file, vat, package, weight, net_value):
+    """
+    Build the ✓/✗ status line for one processed Z* file
+
+    :param file: File name
+    :param vat: Extracted VAT number
+    :param package: Extracted package number
+    :param weight: Extracted weight
+    :param net_value: Extracted net value
+    """
+    missing = []
+    if vat is None:
+        missing.append("VAT")
+    if package is None:
+        missing.append("Paczka")
+    if weight is None:
+        missing.append("Waga")
+    if net_value is None:
+        missing.append("Wartości netto")
+
+    if not missing:
+        return f"✓ {file}"
+    missing_str = ", ".join(missing)
+    return f"✗ {file} (brak: {missing_str})"
+
+
+def processing_founded_files(files, current_dir, col_width=30, workers=1, cache=None,
+                             extractor=extract_vat_package_weight, timings=None,
+                             timeout=None, memory_mb=None, failures=None, cancel=None,
+                             stats=None):
+    """
+    Process Z* files and yield extracted rows in the order of ``files``
+
+    With more than one worker, or with a time or memory limit, the
+    extraction runs in an IsolatedPool. Status lines are printed as soon as
+    each file finishes; rows are held back only until all earlier files are
+    done. At most ``workers * 4`` files are in flight or buffered, so memory
+    does not grow with the batch. Files found in ``cache`` skip pdfplumber
+    entirely. A file that hangs, runs out of memory or crashes its worker
+    gets an empty row and is added to ``failures``. Setting ``cancel``
+    raises ExtractionCancelled and kills the running workers.
+
+    :param files: Iterable of Z* file names in output order (consumed lazily)
+    :param current_dir: Directory containing the files
+    :param col_width: Column width
+    :param workers: Number of worker processes (1 = sequential)
+    :param cache: Optional ExtractionCache
+    :param extractor: Extraction function, must be picklable for workers > 1
+    :param timings: Optional Timings collector for per-file durations
+    :param timeout: Seconds allowed per file, None = no limit
+    :param memory_mb: Memory limit of a worker process in MB (Unix), None = none
+    :param failures: Optional list receiving (file, reason) of failed files
+    :param cancel: Optional threading.Event stopping the extraction
+    :param stats: Optional dict {file: (size, mtime)} from the listing (see
+        get_files_paths, iter_inputs); used entries are removed
+    """
+    print("\n\n🔍 PRZETWARZANIE PLIKÓW")
+    print_separator()
+    print(f"\n  {'Załączniki (Z*)':<{col_width}}")
+
+    def finish(file, result, digest=None, seconds=0.0, stages=None, cached=False):
+        if timings is not None:
+            timings.add_file(file, seconds, stages, cached)
+        vat, package, weight, net_value = result
+        print(f"  {format_status(file, vat, package, weight, net_value)}", flush=True)
+        # Results with nothing found are usually read errors and rows cut short by
+        # --max-pages miss pages - do not cache them
+        if cache is not None and digest is not None and cacheable(result):
+            cache.put(digest, result)
+        return vat, weight, package, net_value
+
+    def lookup(file, pdf_path):
+        if cache is None:
+            return None, None
+        digest = cache.digest(pdf_path, stats.pop(file, None) if stats else None)
+        return digest, cache.get(digest)
+
+    def run_one(file, pdf_path, digest):
+        result, seconds, stages = timed_extract(extractor, pdf_path)
+        return finish(file, result, digest, seconds, stages)
+
+    def fail(file, reason):
+        if failures is not None:
+            failures.append((file, reason))
+        print(f"  ✗ {file} (błąd: {reason})", flush=True)
+        return None, None, None, None
+
+    if workers <= 1 and not timeout and not memory_mb:
+        for file in files:
+            check_cancel(cancel)
+            pdf_path = os.path.join(current_dir, file)
+            digest, cached = lookup(file, pdf_path)
+            if cached is not None:
+                yield finish(file, cached, cached=True)
+            else:
+                yield run_one(file, pdf_path, digest)
+        return
+
+    window = workers * 4
+    futures = {}
+    done = {}
+    next_idx = 0
+
+    def collect_finished():
+        finished = None
+        while not finished:
+            check_cancel(cancel)
+            finished, _ = wait(futures, timeout=0.2, return_when=FIRST_COMPLETED)
+        for future in finished:
+            idx, file, digest = futures.pop(future)
+            try:
+                result, seconds, stages = future.result()
+            except ExtractionFailed as e:
+                done[idx] = fail(file, str(e))
+                continue
+            done[idx] = finish(file, result, digest, seconds, stages)
+
+    with IsolatedPool(workers, timeout=timeout, memory_mb=memory_mb) as executor:
+        for idx, file in enumerate(files):
+            check_cancel(cancel)
+            pdf_path = os.path.join(current_dir, file)
+            digest, cached = lookup(file, pdf_path)
+            if cached is not None:
+                done[idx] = finish(file, cached, cached=True)
+            else:
+                futures[executor.submit(timed_extract, extractor, pdf_path)] = (idx, file, digest)
+
+            while True:
+                while next_idx in done:
+                    yield done.pop(next_idx)
+                    next_idx += 1
+                if not futures or idx + 1 - next_idx < window:
+                    break
+                collect_finished()
+
+        while futures:
+            collect_finished()
+            while next_idx in done:
+                yield done.pop(next_idx)
+                next_idx += 1
+
+
+# Weights outside (kg): zero or more than a full truck load are reading errors
+WEIGHT_RANGE = (0.001, 24000.0)
+# Values further than this many interquartile ranges from the quartiles are outliers
+OUTLIER_IQR = 3.0
+VALIDATION_HEADER = ["Wiersz", "FV", "Paczka", "Pole", "Wartość", "Problem"]
+
+
+def numeric_checks(column, low, high):
+    """
+    Check a numeric column in one vectorised pass
+
+    Returns (present, total, out of range indices, outlier indices); NaN
+    marks missing values. Uses numpy when installed, plain Python otherwise.
+
+    :param column: array("d") of values
+    :param low: Lowest valid value (or None)
+    :param high: Highest valid value (or None)
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is not None:
+        values = np.frombuffer(column, dtype=np.float64) if len(column) else np.empty(0)
+        present = ~np.isnan(values)
+        found = values[present]
+        bad = np.zeros(len(values), dtype=bool)
+        if low is not None:
+            bad |= present & (values < low)
+        if high is not None:
+            bad |= present & (values > high)
+        outliers = np.empty(0, dtype=np.intp)
+        if len(found) >= 4:
+            q1, q3 = np.percentile(found, [25, 75])
+            spread = OUTLIER_IQR * (q3 - q1)
+            if spread:
+                outliers = np.flatnonzero(
+                    present & ((values < q1 - spread) | (values > q3 + spread))
+                )
+        return (int(present.sum()), float(found.sum()),
+                np.flatnonzero(bad).tolist(), outliers.tolist())
+
+    found = [(idx, value) for idx, value in enumerate(column) if value == value]
+    bad = [idx for idx, value in found
+           if (low is not None and value < low) or (high is not None and value > high)]
+    outliers = []
+    if len(found) >= 4:
+        q1, _, q3 = statistics.quantiles((value for _, value in found), n=4,
+                                         method="inclusive")
+        spread = OUTLIER_IQR * (q3 - q1)
+        if spread:
+            outliers = [idx for idx, value in found
+                        if value < q1 - spread or value > q3 + spread]
+    return len(found), math.fsum(value for _, value in found), bad, outliers
+
+
+class Validation:
+    """Completeness, totals and problems found in the rows of a RowStats"""
+
+    def __init__(self, stats):
+        self.total = len(stats.vats)
+        self.vat = sum(vat is not None for vat in stats.vats)
+        self.package = sum(package is not None for package in stats.packages)
+        self.weight, self.weight_sum, self.bad_weight, weight_outliers = numeric_checks(
+            stats.weights, *WEIGHT_RANGE
+        )
+        # Bad weights are reported once, not again as outliers
+        bad = set(self.bad_weight)
+        weight_outliers = [idx for idx in weight_outliers if idx not in bad]
+        self.net_value, self.net_value_sum, _, net_value_outliers = numeric_checks(
+            stats.net_values, None, None
+        )
+        self.outliers = {"weight": weight_outliers, "net_value": net_value_outliers}
+        self.bad_vat = [idx for idx, vat in enumerate(stats.vats)
+                        if vat is not None and not ATTACHMENT_TEMPLATES.valid_vat(vat)]
+
+        rows_of = collections.defaultdict(list)
+        for idx, package in enumerate(stats.packages):
+            if package is not None:
+                rows_of[package].append(idx)
+        self.duplicate_packages = {p: rows for p, rows in rows_of.items() if len(rows) > 1}
+
+        self.incomplete = sum(
+            1 for row in zip(stats.vats, stats.packages, stats.weights, stats.net_values)
+            if None in row[:2] or row[2] != row[2] or row[3] != row[3]
+        )
+
+    def problems(self):
+        """Yield (row index, field, problem) sorted by row"""
+        found = [(idx, "vat", "błędny format FV") for idx in self.bad_vat]
+        found += [(idx, "weight", f"waga poza zakresem {WEIGHT_RANGE[0]:g}–{WEIGHT_RANGE[1]:g}")
+                  for idx in self.bad_weight]
+        for field, rows in self.outliers.items():
+            found += [(idx, field, "wartość odstająca") for idx in rows]
+        for rows in self.duplicate_packages.values():
+            found += [(idx, "package", f"paczka powtórzona {len(rows)}×") for idx in rows]
+        found.sort()
+        return found
+
+    def sheet_rows(self, stats):
+        """
+        Rows of the "Walidacja" sheet; row numbers match the "Dane Faktur" sheet
+
+        :param stats: RowStats the validation was computed from
+        """
+        for idx, field, problem in self.problems():
+            row = stats.row(idx)
+            vat, weight, package, net_value = row
+            value = {"vat": vat, "weight": weight, "package": package,
+                     "net_value": net_value}[field]
+            yield [idx + 2, vat, package, FIELD_LABELS[field], value, problem]
+
+
+FIELD_LABELS = {"vat": "FV", "weight": "Waga", "package": "Paczka", "net_value": "Wartość"}
+
+
+class RowStats:
+    """
+    Extracted rows collected column by column
+
+    Rows are appended as they stream past. Completeness, totals and
+    problems are computed by :meth:`check` in one pass over the columns;
+    the count attributes (``total``, ``vat``, ...) read from it.
+    """
+
+    def __init__(self):
+        self.vats = []
+        self.packages = []
+        self.weights = array.array("d")
+        self.net_values = array.array("d")
+        self.validation = None
+
+    def add(self, row):
+        """
+        Add one row
+
+        :param row: Tuple (vat, weight, package, net_value)
+        """
+        vat, weight, package, net_value = row
+        self.vats.append(vat)
+        self.packages.append(package)
+        self.weights.append(math.nan if weight is None else weight)
+        self.net_values.append(math.nan if net_value is None else net_value)
+        self.validation = None
+
+    def row(self, idx):
+        """
+        Return row ``idx`` as (vat, weight, package, net_value)
+
+        :param idx: Row index
+        """
+        weight = self.weights[idx]
+        net_value = self.net_values[idx]
+        return (self.vats[idx], None if weight != weight else weight,
+                self.packages[idx], None if net_value != net_value else net_value)
+
+    def check(self):
+        """Validate all rows added so far (cached until the next add)"""
+        if self.validation is None:
+            self.validation = Validation(self)
+        return self.validation
+
+    @property
+    def total(self):
+        return len(self.vats)
+
+    @property
+    def vat(self):
+        return self.check().vat
+
+    @property
+    def weight(self):
+        return self.check().weight
+
+    @property
+    def package(self):
+        return self.check().package
+
+    @property
+    def net_value(self):
+        return self.check().net_value
+
+    @property
+    def incomplete(self):
+        return self.check().incomplete
+
+
+def count_rows(rows, stats):
+    """
+    Pipeline stage updating ``stats`` as rows pass through
+
+    :param rows: Iterable of rows
+    :param stats: RowStats to update
+    """
+    for row in rows:
+        stats.add(row)
+        yield row
+
+
+VAT_SUM_HEADER = ["FV", "Wiersze", "Paczki", "Waga", "Wartość", "Braki"]
+PACKAGE_SUM_HEADER = ["Paczka", "Wiersze", "FV", "Waga", "Wartość", "Braki"]
+MISSING_HEADER = ["Wiersz", "FV", "Paczka", "Brak"]
+
+
+class Aggregates:
+    """
+    Per-VAT and per-package totals of the rows in a RowStats
+
+    Built in one pass over the RowStats columns after extraction, so no
+    second copy of the rows is kept while they stream. Totals of all rows
+    come from :meth:`RowStats.check`. Row numbers of the missing-data list
+    match the "Dane Faktur" sheet.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        # key -> [rows, weight, net value, rows with missing data, other keys]
+        self.by_vat = {}
+        self.by_package = {}
+        self.missing = []
+        columns = zip(stats.vats, stats.packages, stats.weights, stats.net_values)
+        for idx, (vat, package, weight, net_value) in enumerate(columns):
+            missing = vat is None or package is None or weight != weight or net_value != net_value
+            if missing:
+                self.missing.append(idx)
+            if vat is not None:
+                self.update(self.by_vat, vat, package, weight, net_value, missing)
+            if package is not None:
+                self.update(self.by_package, package, vat, weight, net_value, missing)
+
+    @staticmethod
+    def update(groups, key, other, weight, net_value, missing):
+        group = groups.get(key)
+        if group is None:
+            # A set is only made once a second distinct key shows up
+            groups[key] = [1, weight if weight == weight else 0.0,
+                           net_value if net_value == net_value else 0.0, int(missing), other]
+            return
+        group[0] += 1
+        if weight == weight:
+            group[1] += weight
+        if net_value == net_value:
+            group[2] += net_value
+        if missing:
+            group[3] += 1
+        if other is not None and other != group[4]:
+            if isinstance(group[4], set):
+                group[4].add(other)
+            elif group[4] is None:
+                group[4] = other
+            else:
+                group[4] = {group[4], other}
+
+    @staticmethod
+    def others(value):
+        """Sorted distinct keys of a group"""
+        if value is None:
+            return []
+        return sorted(value) if isinstance(value, set) else [value]
+
+    def vat_rows(self):
+        """Rows of the "Suma FV" sheet, sorted by VAT number, with a total row"""
+        for vat in sorted(self.by_vat):
+            count, weight, net_value, missing, packages = self.by_vat[vat]
+            yield [vat, count, len(self.others(packages)), round(weight, 3),
+                   round(net_value, 2), missing]
+        check = self.stats.check()
+        yield ["Razem", self.stats.total, len(self.by_package), round(check.weight_sum, 3),
+               round(check.net_value_sum, 2), check.incomplete]
+
+    def package_rows(self):
+        """Rows of the "Suma Paczki" sheet, sorted by package number"""
+        for package in sorted(self.by_package):
+            count, weight, net_value, missing, vats = self.by_package[package]
+            yield [package, count, ", ".join(self.others(vats)), round(weight, 3),
+                   round(net_value, 2), missing]
+
+    def missing_rows(self):
+        """Rows of the "Braki" sheet"""
+        for idx in self.missing:
+            row = self.stats.row(idx)
+            labels = [label for label, value in zip(OUTPUT_HEADER, row) if value is None]
+            yield [idx + 2, row[0], row[2], ", ".join(labels)]
+
+
+def add_report_sheets(sink, stats, aggregates=True):
+    """
+    Add the "Walidacja" sheet and, unless disabled, the aggregate sheets
+
+    :param sink: ExcelSink or CsvSink
+    :param stats: RowStats of the written rows
+    :param aggregates: Add "Suma FV", "Suma Paczki" and "Braki"
+    """
+    if stats.check().problems():
+        sink.add_sheet("Walidacja", VALIDATION_HEADER, stats.check().sheet_rows(stats))
+    if aggregates and stats.total:
+        totals = Aggregates(stats)
+        sink.add_sheet("Suma FV", VAT_SUM_HEADER, totals.vat_rows())
+        sink.add_sheet("Suma Paczki", PACKAGE_SUM_HEADER, totals.package_rows())
+        if totals.missing:
+            sink.add_sheet("Braki", MISSING_HEADER, totals.missing_rows())
+
+
+def write_rows(rows, sink):
+    """
+    Pipeline sink writing every row
+
+    :param rows: Iterable of rows
+    :param sink: ExcelSink or CsvSink
+    """
+    for row in rows:
+        sink.write(row)
+
+
+def match_key(value):
+    """
+    Normalise VAT/package number for joining: digits only, no leading zeros
+
+    :param value: Number as text (or None)
+    """
+    if value is None:
+        return None
+    digits = re.sub(r"\D", "", str(value))
+    if not digits:
+        return None
+    return digits.lstrip("0") or "0"
+
+
+# 9* invoices are joined on the last digits of the package number, as the
+# original extract_package kept only these from "Paczka:"
+PACKAGE_KEY_DIGITS = 6
+
+
+def package_key(value):
+    """
+    Package number for joining invoices: its last PACKAGE_KEY_DIGITS digits
+
+    :param value: Package number as text (or None)
+    """
+    if value is None:
+        return None
+    digits = re.sub(r"\D", "", str(value))
+    return digits[-PACKAGE_KEY_DIGITS:] or None
+
+
+class InvoiceMatcher:
+    """
+    Hash join of 9* invoices with Z* rows
+
+    The package and VAT indexes are built from the columns of a RowStats
+    once extraction is done, so no second copy of the rows is kept. Every
+    invoice is looked up by its "Paczka:" number, falling back to the
+    invoice number from its file name (009123... -> VAT nr 9123...). Both
+    steps are dictionary lookups, so the join is linear in the number of
+    files. Packages are compared by :func:`package_key`.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.by_package = self.build_index(stats.packages, package_key)
+        self.by_vat = self.build_index(stats.vats, match_key)
+
+    @staticmethod
+    def build_index(column, key_of):
+        """
+        Map normalised key -> row number, or a list of row numbers when repeated
+
+        :param column: Column of VAT or package numbers
+        :param key_of: match_key or package_key
+        """
+        index = {}
+        for row_no, value in enumerate(column):
+            key = key_of(value)
+            if key is None:
+                continue
+            found = index.get(key)
+            if found is None:
+                index[key] = row_no
+            elif isinstance(found, list):
+                found.append(row_no)
+            else:
+                index[key] = [found, row_no]
+        return index
+
+    @staticmethod
+    def lookup(index, key):
+        found = index.get(key)
+        if found is None:
+            return []
+        return found if isinstance(found, list) else [found]
+
+    def match(self, invoices):
+        """
+        Join invoices with the indexed rows
+
+        :param invoices: Iterable of (invoice file name, package number or None)
+        """
+        report = MatchReport()
+        used_rows = set()
+        invoice_packages = {}
+
+        for file, package in invoices:
+            key = package_key(package)
+            rows, method = [], None
+            if key is not None and key in self.by_package:
+                rows, method = self.lookup(self.by_package, key), "paczka"
+            else:
+                vat_key = match_key(os.path.splitext(os.path.basename(file))[0])
+                if vat_key in self.by_vat:
+                    rows, method = self.lookup(self.by_vat, vat_key), "numer FV"
+
+            if key is not None:
+                invoice_packages.setdefault(key, []).append(file)
+            if not rows:
+                report.unmatched_invoices.append(file)
+                report.lines.append((file, package, None, "brak"))
+                continue
+            report.matched[method] = report.matched.get(method, 0) + 1
+            for row_no in rows:
+                used_rows.add(row_no)
+                report.lines.append((file, package, row_no, method))
+
+        report.unmatched_rows = [idx for idx in range(self.stats.total) if idx not in used_rows]
+        report.duplicate_packages = {k: len(v) for k, v in self.by_package.items()
+                                     if isinstance(v, list)}
+        report.duplicate_invoices = {k: v for k, v in invoice_packages.items() if len(v) > 1}
+        return report
+
+
+MATCH_HEADER = ["Faktura (9*)", "Paczka (9*)", "Wiersz", "FV", "Waga", "Paczka", "Wartość", "Dopasowanie"]
+
+
+class MatchReport:
+    """Result of InvoiceMatcher.match"""
+
+    def __init__(self):
+        self.lines = []
+        self.matched = {}
+        self.unmatched_invoices = []
+        self.unmatched_rows = []
+        self.duplicate_packages = {}
+        self.duplicate_invoices = {}
+
+    def sheet_rows(self, stats):
+        """
+        Rows of the "Dopasowanie" sheet: every invoice, then Z* rows without invoice
+
+        "Wiersz" is the row number in the "Dane Faktur" sheet.
+
+        :param stats: RowStats the matcher was built from
+        """
+        for file, package, row_no, method in self.lines:
+            if row_no is None:
+                yield [os.path.basename(file), package, None, None, None, None, None, method]
+            else:
+                yield [os.path.basename(file), package, row_no + 2,
+                       *excel_row(*stats.row(row_no)), method]
+        for row_no in self.unmatched_rows:
+            yield [None, None, row_no + 2, *excel_row(*stats.row(row_no)), "brak faktury"]
+
+
+def iter_invoice_packages(files, current_dir, workers=1, extractor=extract_invoice_package,
+                          timeout=None, memory_mb=None, cancel=None):
+    """
+    Yield (file, package number) for 9* invoices, in order
+
+    With more than one worker, or with a time or memory limit, the invoices
+    are read in an IsolatedPool; one that fails gets no package number.
+
+    :param files: Invoice file names (or absolute paths with empty current_dir)
+    :param current_dir: Directory containing the files
+    :param workers: Number of worker processes
+    :param extractor: Package extraction function, picklable for the pool
+    :param timeout: Seconds allowed per file, None = no limit
+    :param memory_mb: Memory limit of a worker process in MB (Unix), None = none
+    :param cancel: Optional threading.Event stopping the reading
+    """
+    paths = (os.path.join(current_dir, f) for f in files)
+    if workers <= 1 and not timeout and not memory_mb:
+        for file, path in zip(files, paths):
+            check_cancel(cancel)
+            yield file, extractor(path)
+        return
+
+    def result(file, future):
+        try:
+            return file, wait_result(future, cancel)
+        except ExtractionFailed as e:
+            print(f"  ✗ {os.path.basename(file)} (błąd: {e})", flush=True)
+            return file, None
+
+    pending = collections.deque()
+    with IsolatedPool(workers, timeout=timeout, memory_mb=memory_mb) as executor:
+        for file, path in zip(files, paths):
+            pending.append((file, executor.submit(extractor, path)))
+            if len(pending) >= workers * 4:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+
+
+def print_match_report(report, total_invoices):
+    """
+    Print invoice matching summary
+
+    :param report: MatchReport
+    :param total_invoices: Number of 9* invoices
+    """
+    print("\n🔗 DOPASOWANIE FAKTUR (9*) DO ZAŁĄCZNIKÓW (Z*)")
+    print_separator()
+    print(f"  Faktury razem        : {total_invoices}")
+    print(f"  Po numerze paczki    : {report.matched.get('paczka', 0)}")
+    print(f"  Po numerze FV        : {report.matched.get('numer FV', 0)}")
+    print(f"  Faktury bez Z*       : {len(report.unmatched_invoices)}")
+    print(f"  Załączniki bez 9*    : {len(report.unmatched_rows)}")
+
+    for file in report.unmatched_invoices:
+        print(f"  ✗ {os.path.basename(file)} (brak załącznika)")
+    for key, count in report.duplicate_packages.items():
+        print(f"  ⚠ Paczka {key} występuje w {count} załącznikach")
+    for key, files in report.duplicate_invoices.items():
+        names = ", ".join(os.path.basename(f) for f in files)
+        print(f"  ⚠ Paczka {key} występuje w fakturach: {names}")
+    print_separator()
+
+
+def summary(stats):
+    """
+    Print data summary
+
+    :param stats: RowStats of processed rows
+    """
+    print("\n\n📊 PODSUMOWANIE DANYCH")
+    print_separator()
+
+    check = stats.check()
+    total = check.total
+
+    print(f"  Wiersze razem  : {total}")
+    print(f"  Numery VAT     : {check.vat}/{total}")
+    print(f"  Wagi           : {check.weight}/{total}")
+    print(f"  Numery paczek  : {check.package}/{total}")
+    print(f"  Wartości netto : {check.net_value}/{total}")
+    print(f"  Suma wag       : {check.weight_sum:,.3f}".replace(",", " "))
+    print(f"  Suma netto     : {check.net_value_sum:,.2f}".replace(",", " "))
+
+    if check.incomplete:
+        print(f"\n  ⚠ {check.incomplete} wiersze mają braki — komórki zostawione puste")
+    else:
+        print("  ✓ Wszystkie dane kompletne")
+
+    outliers = sum(len(rows) for rows in check.outliers.values())
+    duplicated_rows = sum(len(rows) for rows in check.duplicate_packages.values())
+    if check.bad_vat:
+        print(f"  ⚠ Błędny format FV      : {len(check.bad_vat)}")
+    if check.bad_weight:
+        print(f"  ⚠ Waga poza zakresem    : {len(check.bad_weight)}")
+    if check.duplicate_packages:
+        print(f"  ⚠ Powtórzone paczki     : {len(check.duplicate_packages)} "
+              f"(wiersze: {duplicated_rows})")
+    if outliers:
+        print(f"  ⚠ Wartości odstające    : {outliers}")
+
+    print_separator()
+
+
+OUTPUT_HEADER = ["FV", "Waga", "Paczka", "Wartość"]
+OUTPUT_FORMATS = ("xlsx", "csv")
+
+
+def excel_row(vat, weight, package, net_value):
+    """
+    Build one worksheet row from extracted values
+
+    :param vat: VAT number
+    :param weight: Weight
+    :param package: Package number
+    :param net_value: Net value
+    """
+    fv_cell = f"{vat}" if vat else None
+    return [fv_cell, weight, package, net_value]
+
+
+def build_workbook(rows):
+    """
+    Build editable in-memory workbook with "Dane Faktur" sheet
+
+    :param rows: Rows (vat, weight, package, net_value)
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Dane Faktur"
+
+    ws.append(OUTPUT_HEADER)
+
+    for row in rows:
+        ws.append(excel_row(*row))
+
+    return wb
+
+
+class ExcelSink:
+    """
+    Streaming xlsx output using openpyxl write-only mode
+
+    Rows are serialised as they are written, so memory stays flat
+    regardless of the number of rows.
+    """
+
+    def __init__(self, file_name):
+        from openpyxl import Workbook
+
+        self.file_name = file_name
+        self.row_count = 0
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet("Dane Faktur")
+        self.ws.append(OUTPUT_HEADER)
+
+    def write(self, row):
+        """
+        Write one row
+
+        :param row: Tuple (vat, weight, package, net_value)
+        """
+        self.ws.append(excel_row(*row))
+        self.row_count += 1
+
+    def add_sheet(self, title, header, rows):
+        """
+        Add another sheet; must be called before close()
+
+        :param title: Sheet title
+        :param header: Header row
+        :param rows: Iterable of rows
+        """
+        ws = self.wb.create_sheet(title)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+
+    def close(self):
+        """Save the workbook"""
+        self.wb.save(self.file_name)
+
+
+def csv_cell(value):
+    """
+    Format a value for Polish Excel CSV (decimal comma)
+
+    :param value: Cell value
+    """
+    return str(value).replace(".", ",") if isinstance(value, float) else value
+
+
+class CsvSink:
+    """Streaming CSV output readable by Polish Excel (";" separated, UTF-8 BOM)"""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.row_count = 0
+        self.file = open(file_name, "w", newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.file, delimiter=";")
+        self.writer.writerow(OUTPUT_HEADER)
+
+    def write(self, row):
+        """
+        Write one row
+
+        :param row: Tuple (vat, weight, package, net_value)
+        """
+        self.writer.writerow([csv_cell(value) for value in excel_row(*row)])
+        self.row_count += 1
+
+    def add_sheet(self, title, header, rows):
+        """
+        Write another table to "<name>_<title>.csv" next to the main file
+
+        :param title: Table title
+        :param header: Header row
+        :param rows: Iterable of rows
+        """
+        root, ext = os.path.splitext(self.file_name)
+        file_name = f"{root}_{title.lower().replace(' ', '_')}{ext}"
+        with open(file_name, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(header)
+            writer.writerows([csv_cell(value) for value in row] for row in rows)
+
+    def close(self):
+        """Close the file"""
+        self.file.close()
+
+
+def create_sink(file_name="fv_waga.xlsx"):
+    """
+    Open output sink, CSV for .csv files and xlsx otherwise
+
+    :param file_name: Output path
+    """
+    if file_name.lower().endswith(".csv"):
+        return CsvSink(file_name)
+    return ExcelSink(file_name)
+
+
+def excel_create(sink):
+    """
+    Finish output file with extracted data
+
+    :param sink: ExcelSink or CsvSink rows were streamed into
+    """
+    print("\n💾 TWORZENIE PLIKU EXCEL")
+    print_separator()
+
+    sink.close()
+    file_name = sink.file_name
+
+    print(f"  ✓ Plik zapisany : {file_name}")
+    print(f"  ✓ Dodano wierszy: {sink.row_count}")
+    print_separator()
+
+    return file_name
+
+
+HISTORY_FILE = "fv_history.sqlite"
+HISTORY_SCHEMA = 2
+HISTORY_HEADER = ["Data", "FV", "Paczka", "Waga", "Wartość", "Plik"]
+DAILY_HEADER = ["Data", "Wiersze", "Waga", "Wartość"]
+HISTORY_PREVIEW = 50
+
+
+class HistoryStore:
+    """
+    SQLite history of extracted rows across batches
+
+    Every run is one batch; its rows are buffered and inserted with
+    executemany in chunks of ``chunk_size`` inside a single transaction.
+    Rows keep the processing date plus VAT and package numbers normalised
+    with :func:`match_key`, indexed so that lookups by VAT, package, source
+    file or date range stay fast on millions of rows. A row is identified by
+    its source file and document (VAT and package number): a file processed
+    again, on any day, updates its row and keeps the day it was first seen,
+    so files left in the folder are not counted again every day. Fields not
+    found this time keep their earlier values and rows without any field
+    (failed reads) are not stored.
+    """
+
+    def __init__(self, path=HISTORY_FILE, chunk_size=1000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.batch_id = None
+        self.day = None
+        self.rows = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 1:
+            self.migrate_v1()
+        if version < HISTORY_SCHEMA:
+            self.conn.execute(f"PRAGMA user_version = {HISTORY_SCHEMA}")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY,
+                started REAL NOT NULL,
+                output TEXT,
+                row_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                batch_id INTEGER NOT NULL REFERENCES batches (id),
+                day TEXT NOT NULL,
+                source TEXT NOT NULL,
+                vat TEXT,
+                vat_key TEXT,
+                package TEXT,
+                package_key TEXT,
+                weight REAL,
+                net_value REAL,
+                document TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS idx_results_vat_day ON results (vat_key, day);
+            CREATE INDEX IF NOT EXISTS idx_results_package ON results (package_key);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_results_document ON results (source, document);
+            CREATE INDEX IF NOT EXISTS idx_results_day ON results (day, weight, net_value);
+            """
+        )
+        self.conn.commit()
+
+    def migrate_v1(self):
+        """Key schema 1 rows by document, keeping the first row of each file"""
+        self.conn.executescript(
+            """
+            ALTER TABLE results ADD COLUMN document TEXT NOT NULL DEFAULT '';
+            UPDATE results SET document = COALESCE(vat_key, '') || '|' || COALESCE(package_key, '');
+            DELETE FROM results WHERE rowid NOT IN
+                (SELECT MIN(rowid) FROM results GROUP BY source, document);
+            DROP INDEX IF EXISTS idx_results_source_day;
+            """
+        )
+
+    def start_batch(self, output=None):
+        """
+        Register a new batch, rows added afterwards belong to it
+
+        :param output: Output file written by the batch
+        """
+        now = time.time()
+        self.day = time.strftime("%Y-%m-%d", time.localtime(now))
+        self.rows = 0
+        self.batch_id = self.conn.execute(
+            "INSERT INTO batches (started, output) VALUES (?, ?)", (now, output)
+        ).lastrowid
+        return self.batch_id
+
+    def add(self, source, row):
+        """
+        Buffer one extracted row
+
+        :param source: Path of the Z* file
+        :param row: Tuple (vat, weight, package, net_value)
+        """
+        vat, weight, package, net_value = row
+        if vat is None and weight is None and package is None and net_value is None:
+            # Failed read (timeout, damaged file); keep what an earlier run found
+            return
+        vat_key, package_key = match_key(vat), match_key(package)
+        self.pending.append((
+            self.batch_id, self.day, source, vat, vat_key, package, package_key,
+            weight, net_value, f"{vat_key or ''}|{package_key or ''}"
+        ))
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Insert buffered rows"""
+        if self.pending:
+            # A file read again updates its row and keeps its first day; fields
+            # missing this time keep their earlier value
+            self.conn.executemany(
+                """
+                INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, document) DO UPDATE SET
+                    batch_id = excluded.batch_id,
+                    vat = excluded.vat,
+                    package = excluded.package,
+                    weight = COALESCE(excluded.weight, weight),
+                    net_value = COALESCE(excluded.net_value, net_value)
+                """,
+                self.pending
+            )
+            self.rows += len(self.pending)
+            self.pending = []
+
+    def finish_batch(self):
+        """Insert remaining rows and commit the batch"""
+        self.flush()
+        self.conn.execute(
+            "UPDATE batches SET row_count = ? WHERE id = ?", (self.rows, self.batch_id)
+        )
+        self.conn.commit()
+
+    def rows_for(self, vat=None, package=None, since=None, until=None):
+        """
+        Return history rows (day, vat, package, weight, net_value, source)
+
+        :param vat: Optional VAT number
+        :param package: Optional package number
+        :param since: Optional first day, "YYYY-MM-DD"
+        :param until: Optional last day, "YYYY-MM-DD"
+        """
+        where, params = self.filters(vat, package, since, until)
+        return self.conn.execute(
+            "SELECT day, vat, package, weight, net_value, source FROM results"
+            f"{where} ORDER BY day, rowid",
+            params
+        )
+
+    def totals_per_day(self, vat=None, since=None, until=None):
+        """
+        Return (day, rows, total weight, total net value) per processing day
+
+        :param vat: Optional VAT number
+        :param since: Optional first day, "YYYY-MM-DD"
+        :param until: Optional last day, "YYYY-MM-DD"
+        """
+        where, params = self.filters(vat, None, since, until)
+        return self.conn.execute(
+            "SELECT day, COUNT(*), ROUND(TOTAL(weight), 3), ROUND(TOTAL(net_value), 2) "
+            f"FROM results{where} GROUP BY day ORDER BY day",
+            params
+        )
+
+    @staticmethod
+    def filters(vat, package, since, until):
+        conditions = []
+        params = []
+        if vat is not None:
+            conditions.append("vat_key = ?")
+            params.append(match_key(vat))
+        if package is not None:
+            conditions.append("package_key = ?")
+            params.append(match_key(package))
+        if since is not None:
+            conditions.append("day >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("day <= ?")
+            params.append(until)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where, params
+
+    def close(self):
+        """Commit and close the database"""
+        self.flush()
+        self.conn.commit()
+        self.conn.close()
+
+
+def store_rows(rows, history, sources):
+    """
+    Pipeline stage saving rows to the history store
+
+    :param rows: Iterable of rows
+    :param history: HistoryStore with a started batch
+    :param sources: Iterable of source paths, one per row in the same order
+    """
+    for row, source in zip(rows, sources):
+        history.add(source, row)
+        yield row
+
+
+def export_table(file_name, title, header, rows):
+    """
+    Write one table to xlsx, or to CSV when the name ends with .csv
+
+    :param file_name: Output path
+    :param title: Sheet title
+    :param header: Header row
+    :param rows: Iterable of rows
+    """
+    if file_name.lower().endswith(".csv"):
+        with open(file_name, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(header)
+            writer.writerows([csv_cell(value) for value in row] for row in rows)
+        return
+
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.append(header)
+    for row in rows:
+        ws.append(list(row))
+    wb.save(file_name)
+
+
+def run_history(args):
+    """
+    Query the history store and print or export the result, returns exit code
+
+    :param args: Parsed command line options
+    """
+    if not os.path.exists(args.history):
+        print(f"⚠ UWAGA: Brak historii ({args.history})")
+        return EXIT_NO_FILES
+
+    history = HistoryStore(args.history)
+    try:
+        start = time.perf_counter()
+        if args.history_daily:
+            title, header = "Dzienne sumy", DAILY_HEADER
+            rows = history.totals_per_day(args.history_vat, args.since, args.until)
+        else:
+            title, header = "Wiersze", HISTORY_HEADER
+            rows = history.rows_for(
+                args.history_vat, args.history_package, args.since, args.until
+            )
+
+        print(f"\n\n🗄️  HISTORIA WYNIKÓW ({title})")
+        print_separator()
+        if args.export:
+            count = 0
+
+            def counted(rows):
+                nonlocal count
+                for count, row in enumerate(rows, 1):
+                    yield row
+
+            export_table(args.export, title, header, counted(rows))
+            print(f"  ✓ Plik zapisany : {args.export}")
+            print(f"  ✓ Wierszy       : {count}")
+        else:
+            rows = rows.fetchall()
+            print("  " + " | ".join(header))
+            for row in rows[:HISTORY_PREVIEW]:
+                print("  " + " | ".join("-" if v is None else str(v) for v in row))
+            if len(rows) > HISTORY_PREVIEW:
+                print(f"  … i {len(rows) - HISTORY_PREVIEW} więcej (użyj --export)")
+            print(f"  Wierszy        : {len(rows)}")
+        print(f"  Czas zapytania : {time.perf_counter() - start:.3f} s")
+        print_separator()
+        return EXIT_OK
+    finally:
+        history.close()
+
+
+def scan_pdf_files(current_dir):
+    """
+    Snapshot Z* and 9* PDF files as {name: (size, mtime)}
+
+    :param current_dir: Directory to scan
+    """
+    return FileIndex.scan(current_dir).snapshot()
+
+
+def save_workbook(wb, file_name):
+    """
+    Save workbook, returning False when the file is locked (e.g. open in Excel)
+
+    A .csv path gets the active sheet in the format of CsvSink.
+
+    :param wb: Workbook to save
+    :param file_name: Output path
+    """
+    try:
+        if file_name.lower().endswith(".csv"):
+            with open(file_name, "w", newline="", encoding="utf-8-sig") as f:
+                writer = csv.writer(f, delimiter=";")
+                for row in wb.active.iter_rows(values_only=True):
+                    writer.writerow([csv_cell(value) for value in row])
+        else:
+            wb.save(file_name)
+        return True
+    except PermissionError:
+        print(f"  ⚠ Nie można zapisać {file_name} (plik otwarty?) — ponowię przy następnej zmianie")
+        return False
+
+
+def watch_folder(current_dir, cache=None, workers=1, interval=2.0,
+                 extractor=extract_vat_package_weight, timeout=None, memory_mb=None,
+                 file_name="fv_waga.xlsx"):
+    """
+    Watch directory and update the workbook as new Z*/9* files arrive
+
+    The folder is polled every ``interval`` seconds. A file is processed only
+    once its size and modification time are unchanged between two polls, so
+    files still being copied are not read half-written. New Z* files are
+    appended to the workbook, modified ones update their existing row.
+
+    :param current_dir: Directory to watch
+    :param cache: Optional ExtractionCache
+    :param workers: Worker processes for the initial scan
+    :param interval: Polling interval in seconds
+    :param extractor: Extraction function
+    :param timeout: Seconds allowed per file, None = no limit
+    :param memory_mb: Memory limit of a worker process in MB (Unix), None = none
+    :param file_name: Output path (.xlsx or .csv)
+    """
+    known = scan_pdf_files(current_dir)
+    z_files = sorted(f for f in known if is_attachment(f))
+
+    rows = []
+    if z_files:
+        rows = list(processing_founded_files(
+            z_files, current_dir, workers=workers, cache=cache, extractor=extractor,
+            timeout=timeout, memory_mb=memory_mb, stats=dict(known)
+        ))
+    wb = build_workbook(rows)
+    ws = wb.active
+    row_of = {file: idx for idx, file in enumerate(z_files, 2)}
+    save_workbook(wb, file_name)
+
+    print("\n\n👀 OBSERWOWANIE FOLDERU")
+    print_separator()
+    print(f"  Folder : {current_dir}")
+    print(f"  Plik   : {file_name}")
+    print("  Naciśnij Ctrl+C aby zakończyć\n")
+
+    pending = {}
+    dirty = False
+    # New files are read one at a time, under the same limits as the first scan
+    executor = IsolatedPool(1, timeout=timeout, memory_mb=memory_mb) if timeout or memory_mb else None
+    try:
+        while True:
+            time.sleep(interval)
+            snapshot = scan_pdf_files(current_dir)
+
+            ready = []
+            for name, signature in snapshot.items():
+                if known.get(name) == signature:
+                    continue
+                if pending.get(name) == signature:
+                    ready.append(name)
+                    del pending[name]
+                else:
+                    pending[name] = signature
+            for name in list(pending):
+                if name not in snapshot:
+                    del pending[name]
+
+            for name in sorted(ready):
+                is_new = name not in known
+                known[name] = snapshot[name]
+                if is_invoice(name):
+                    label = "nowa" if is_new else "zmieniona"
+                    print(f"  📋 Faktura ({label}): {name}")
+                    continue
+
+                label = "nowy" if is_new else "zmieniony"
+
+                vat, package, weight, net_value = extract_cached(
+                    os.path.join(current_dir, name), cache, extractor, executor, snapshot[name]
+                )
+                print(f"  {format_status(name, vat, package, weight, net_value)} [{label}]", flush=True)
+
+                values = excel_row(vat, weight, package, net_value)
+                if name in row_of:
+                    for col, value in enumerate(values, 1):
+                        ws.cell(row=row_of[name], column=col, value=value)
+                else:
+                    ws.append(values)
+                    row_of[name] = ws.max_row
+                dirty = True
+
+            if dirty:
+                dirty = not save_workbook(wb, file_name)
+                if cache is not None:
+                    cache.commit()
+    except KeyboardInterrupt:
+        if dirty:
+            save_workbook(wb, file_name)
+        print("\n  ⏹️  Zakończono obserwowanie")
+        print_separator()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def printer_command(printer_cmd=None):
+    """
+    Build print command prefix
+
+    Without ``printer_cmd`` SumatraPDF prints to the default printer. It is
+    started without -reuse-instance, so the process only exits once the
+    files are spooled and no fixed pause is needed. A custom command (e.g.
+    "lp -d biuro") gets the PDF paths appended, or substituted for a
+    "{files}" placeholder.
+
+    :param printer_cmd: Optional command line replacing SumatraPDF
+    """
+    if printer_cmd:
+        return shlex.split(printer_cmd, posix=os.name != "nt")
+    return [get_sumatra_path(),
+            "-print-to-default",
+            "-print-settings", "fit",
+            "-exit-when-done"]
+
+
+class PrintScheduler:
+    """
+    Print PDF files in batches through a bounded asyncio job queue
+
+    Each job passes up to ``batch_size`` files to a single printer process
+    and waits for it to exit, at most ``timeout`` seconds per attempt; a
+    hung process is killed. Failed jobs are retried ``retries`` times. With
+    one worker (default) the print order follows the input order.
+    Cancelling :meth:`run_async` kills printer processes still running.
+    """
+
+    def __init__(self, command, batch_size=10, workers=1, queue_size=4, retries=2,
+                 timeout=300, retry_delay=5.0):
+        self.command = command
+        self.batch_size = batch_size
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.printed = 0
+        self.failed = []
+        self.jobs = 0
+        self.total = 0
+
+    def build_command(self, pdf_paths):
+        """
+        Insert file paths into the command
+
+        :param pdf_paths: Files printed by one job
+        """
+        if "{files}" in self.command:
+            idx = self.command.index("{files}")
+            return self.command[:idx] + list(pdf_paths) + self.command[idx + 1:]
+        return self.command + list(pdf_paths)
+
+    async def run_process(self, pdf_paths):
+        """
+        Run the printer once, returning None or an error message
+
+        :param pdf_paths: Files printed by one job
+        """
+        # An own process group on Unix lets kill() also stop children of
+        # wrapper scripts (e.g. "sh -c 'lp ...'")
+        process = await asyncio.create_subprocess_exec(
+            *self.build_command(pdf_paths),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=os.name != "nt"
+        )
+        try:
+            returncode = await asyncio.wait_for(process.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            await self.kill(process)
+            return f"przekroczono {self.timeout} s"
+        except asyncio.CancelledError:
+            await self.kill(process)
+            raise
+        return None if returncode == 0 else f"Kod: {returncode}"
+
+    @staticmethod
+    async def kill(process):
+        """Kill a printer process (and its process group on Unix)"""
+        try:
+            if os.name != "nt":
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+    async def run_job(self, pdf_paths):
+        """
+        Run one print job with retries, returning None or the last error
+
+        :param pdf_paths: Files printed by one job
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay)
+            try:
+                error = await self.run_process(pdf_paths)
+            except OSError as e:
+                error = f"Błąd: {e}"
+            if error is None:
+                return None
+        return error
+
+    async def worker(self, jobs):
+        while True:
+            job = await jobs.get()
+            if job is None:
+                return
+            first, pdf_paths = job
+            error = await self.run_job(pdf_paths)
+            names = ", ".join(os.path.basename(p) for p in pdf_paths)
+            last = first + len(pdf_paths) - 1
+            label = f"{first}-{last}/{self.total}" if self.total else f"{first}-{last}"
+            self.jobs += 1
+            if error is None:
+                self.printed += len(pdf_paths)
+                print(f"  🖨️ [{label}] ✓ {names}", flush=True)
+            else:
+                self.failed.extend(pdf_paths)
+                print(f"  🖨️ [{label}] ✗ {names} ({error})", flush=True)
+
+    async def run_async(self, pdf_paths):
+        """
+        Print all files, returning once every job has finished
+
+        :param pdf_paths: Files to print in print order, either a list or an
+            async iterable (e.g. a :class:`ThreadFeed`) still being filled
+        """
+        if isinstance(pdf_paths, (list, tuple)):
+            self.total = len(pdf_paths)
+            pdf_paths = iter_async(pdf_paths)
+        jobs = asyncio.Queue(maxsize=self.queue_size)
+        workers = [asyncio.create_task(self.worker(jobs)) for _ in range(self.workers)]
+        try:
+            batch = []
+            first = 1
+            async for path in pdf_paths:
+                batch.append(path)
+                if len(batch) == self.batch_size:
+                    await jobs.put((first, batch))
+                    first += len(batch)
+                    batch = []
+            if batch:
+                await jobs.put((first, batch))
+            for _ in workers:
+                await jobs.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def iter_async(items):
+    """Iterate a plain iterable from async code"""
+    for item in items:
+        yield item
+
+
+class ThreadFeed:
+    """
+    Hand items from a worker thread to an asyncio consumer
+
+    :meth:`put` and :meth:`close` may be called from any thread; iterating
+    the feed in the event loop yields the items until the feed is closed.
+    """
+
+    _END = object()
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def close(self):
+        self.put(self._END)
+
+    async def __aiter__(self):
+        while True:
+            item = await self.queue.get()
+            if item is self._END:
+                return
+            yield item
+
+
+SPOOL_DIR = ".fv_spool"
+SPOOL_MANIFEST = "spool.json"
+
+
+class PrintSpool:
+    """
+    Merged print documents with a manifest of the invoices inside them
+
+    Each chunk is one PDF holding the pages of several invoices. The
+    manifest records, per chunk, its status (pending/printed/failed) and
+    the page range of every invoice, so a failed chunk can be reprinted
+    and its pages traced back to invoice files.
+    """
+
+    def __init__(self, directory, chunks=None):
+        self.directory = directory
+        self.chunks = chunks if chunks is not None else []
+
+    @classmethod
+    def create(cls, directory):
+        """
+        Start an empty spool, removing chunks of the previous one
+
+        :param directory: Spool directory (created if missing)
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith("spool-") and name.endswith(".pdf"):
+                os.remove(os.path.join(directory, name))
+        spool = cls(directory)
+        spool.save()
+        return spool
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Read the spool manifest
+
+        :param directory: Spool directory
+        """
+        with open(os.path.join(directory, SPOOL_MANIFEST), encoding="utf-8") as f:
+            return cls(directory, json.load(f)["chunks"])
+
+    def save(self):
+        write_json_atomic(os.path.join(self.directory, SPOOL_MANIFEST), {"chunks": self.chunks})
+
+    def path(self, chunk):
+        return os.path.join(self.directory, self.chunks[chunk]["file"])
+
+    def add_chunk(self, pdf_paths):
+        """
+        Add a pending chunk for ``pdf_paths``, returns the chunk number
+
+        Chunks are numbered and saved on the calling thread only; the PDF
+        itself is built by :meth:`merge`, which may run in another thread.
+
+        :param pdf_paths: Invoice files in print order
+        """
+        chunk = len(self.chunks)
+        self.chunks.append({
+            "file": f"spool-{chunk + 1:04d}.pdf",
+            "status": "pending",
+            "invoices": [{"file": pdf_path, "pages": None} for pdf_path in pdf_paths],
+        })
+        self.save()
+        return chunk
+
+    def merge(self, chunk):
+        """
+        Write the PDF of a chunk, returns its invoices with page ranges
+
+        Only the invoices of this chunk are open at a time; their pages
+        are copied into the writer and saved before the next chunk starts.
+        The manifest is not touched, so chunks can be merged in parallel.
+
+        :param chunk: Chunk number from :meth:`add_chunk`
+        """
+        from pypdf import PdfWriter
+
+        writer = PdfWriter()
+        invoices = []
+        page = 1
+        for invoice in self.chunks[chunk]["invoices"]:
+            first = page
+            with mapped_pdf(invoice["file"]) as data:
+                writer.append(data)
+            page = len(writer.pages) + 1
+            invoices.append({"file": invoice["file"], "pages": [first, page - 1]})
+        with open(self.path(chunk), "wb") as f:
+            writer.write(f)
+        writer.close()
+        return invoices
+
+    def mark(self, chunk, error=None):
+        """
+        Record the print result of a chunk
+
+        :param chunk: Chunk number
+        :param error: None when printed, otherwise the error message
+        """
+        entry = self.chunks[chunk]
+        entry["status"] = "printed" if error is None else "failed"
+        entry["error"] = error
+        self.save()
+
+
+class SpoolPrintScheduler(PrintScheduler):
+    """
+    PrintScheduler sending each batch as one merged PDF
+
+    Instead of passing ``batch_size`` files to the printer, every job is
+    merged into a spool chunk first, so the printer and spooler set up
+    once per chunk rather than once per invoice.
+    """
+
+    def __init__(self, command, spool, **kwargs):
+        super().__init__(command, **kwargs)
+        self.spool = spool
+
+    async def run_job(self, pdf_paths):
+        chunk = self.spool.add_chunk(pdf_paths)
+        try:
+            invoices = await asyncio.to_thread(self.spool.merge, chunk)
+        except Exception as e:
+            error = f"Błąd łączenia: {e}"
+        else:
+            self.spool.chunks[chunk]["invoices"] = invoices
+            error = await super().run_job([self.spool.path(chunk)])
+        self.spool.mark(chunk, error)
+        if error is not None:
+            error = f"{error}; {self.spool.chunks[chunk]['file']}"
+        return error
+
+
+def reprint_spool(args):
+    """
+    Print failed (or the selected) chunks of a spool again, returns exit code
+
+    :param args: Parsed command line options
+    """
+    spool = PrintSpool.load(args.reprint)
+    if args.chunk:
+        chunks = [number - 1 for number in args.chunk if 0 < number <= len(spool.chunks)]
+    else:
+        chunks = [idx for idx, entry in enumerate(spool.chunks) if entry["status"] != "printed"]
+    if not chunks:
+        print("  ✓ Brak części do ponownego wydruku")
+        return EXIT_OK
+
+    try:
+        command = printer_command(args.printer_cmd)
+    except Exception as e:
+        print(f"  ❌ {e}")
+        return EXIT_ERROR
+    scheduler = PrintScheduler(command, timeout=args.print_timeout)
+
+    async def run():
+        for chunk in chunks:
+            error = None
+            if not os.path.exists(spool.path(chunk)):
+                # Merging failed last time; build the chunk again
+                try:
+                    spool.chunks[chunk]["invoices"] = spool.merge(chunk)
+                except Exception as e:
+                    error = f"Błąd łączenia: {e}"
+            if error is None:
+                error = await scheduler.run_job([spool.path(chunk)])
+            spool.mark(chunk, error)
+            invoices = ", ".join(
+                os.path.basename(invoice["file"]) for invoice in spool.chunks[chunk]["invoices"]
+            )
+            mark = "✓" if error is None else f"✗ ({error})"
+            print(f"  🖨️ {spool.chunks[chunk]['file']} {mark}: {invoices}", flush=True)
+
+    asyncio.run(run())
+    failed = sum(1 for chunk in chunks if spool.chunks[chunk]["status"] != "printed")
+    return EXIT_ERROR if failed else EXIT_OK
+
+
+def make_scheduler(args):
+    """
+    Create a print scheduler from command line options, or None on error
+
+    :param args: Parsed command line options
+    """
+    try:
+        command = printer_command(args.printer_cmd)
+    except Exception as e:
+        print(f"  ❌ {e}")
+        return None
+    options = {"batch_size": args.print_batch, "workers": args.print_workers,
+               "timeout": args.print_timeout}
+    if args.print_merge:
+        return SpoolPrintScheduler(command, PrintSpool.create(args.spool_dir), **options)
+    return PrintScheduler(command, **options)
+
+
+def print_print_report(scheduler, elapsed):
+    """
+    Print printing statistics
+
+    :param scheduler: Finished PrintScheduler
+    :param elapsed: Printing wall time in seconds
+    """
+    print("\n\n🖨️  DRUKOWANIE FAKTUR")
+    print_separator()
+    per_minute = scheduler.printed / elapsed * 60 if elapsed else 0
+    total = scheduler.printed + len(scheduler.failed)
+    print(f"  Wydrukowano    : {scheduler.printed}/{total} (zadania: {scheduler.jobs})")
+    print(f"  Czas           : {elapsed:.1f} s ({per_minute:.1f} faktur/min)")
+    if scheduler.failed:
+        print(f"  ⚠ Nie wydrukowano {len(scheduler.failed)} faktur:")
+        for path in scheduler.failed:
+            print(f"    • {os.path.basename(path)}")
+    print("  ✅ Wydruk zakończony")
+
+
+async def extract_while_printing(extract, invoices, scheduler, timings=None):
+    """
+    Run blocking extraction in a thread while invoices are printed
+
+    ``extract`` receives a callback to report invoices found while it runs;
+    they are queued for printing at once, so printing overlaps extraction
+    instead of waiting for the Excel file. If extraction fails, pending
+    print jobs are cancelled. If this task is cancelled (Ctrl+C), the
+    ``cancel`` event passed to ``extract`` is set, so the thread stops and
+    kills its workers instead of finishing the batch. Returns the result of
+    ``extract``.
+
+    :param extract: Callable taking an ``on_invoice(path)`` callback and a
+        ``cancel`` threading.Event
+    :param invoices: Invoice paths known up front
+    :param scheduler: PrintScheduler or None to skip printing
+    :param timings: Optional Timings receiving the print stage
+    """
+    loop = asyncio.get_running_loop()
+    feed = ThreadFeed(loop)
+    cancel = threading.Event()
+    for path in invoices:
+        feed.put(path)
+
+    start = time.perf_counter()
+    printing = None
+    if scheduler is not None:
+        printing = asyncio.create_task(scheduler.run_async(feed))
+    try:
+        result = await loop.run_in_executor(None, extract, feed.put, cancel)
+    except BaseException:
+        cancel.set()
+        if printing is not None:
+            printing.cancel()
+            await asyncio.gather(printing, return_exceptions=True)
+        raise
+    finally:
+        feed.close()
+
+    if printing is not None:
+        await printing
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings.add_stage("print", elapsed)
+        print_print_report(scheduler, elapsed)
+    return result
+
+
+def start_profiler(path):
+    """
+    Start profiling this process when ``path`` is given
+
+    Paths ending with .html use pyinstrument if it is installed, anything
+    else gets a cProfile dump (open with pstats or snakeviz). Pool workers
+    run in other processes and are not included.
+
+    :param path: Output path or None
+    """
+    if not path:
+        return None
+    if path.lower().endswith(".html"):
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        except ImportError:
+            print("  ⚠ Brak pyinstrument — używam cProfile")
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, path):
+    """
+    Stop profiler and write its output
+
+    :param profiler: Object returned by start_profiler
+    :param path: Output path
+    """
+    if profiler is None:
+        return
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(profiler.output_html())
+    print(f"  ✓ Profil zapisany: {path}")
+
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_NO_FILES = 3
+EXIT_INCOMPLETE = 4
+
+
+def parse_args(argv=None):
+    """
+    Parse command line options
+
+    :param argv: Argument list (defaults to sys.argv)
+    """
+    parser = argparse.ArgumentParser(
+        description="PDF Parser - Ekstraktor Danych z Załączników",
+        epilog=(
+            "Bez argumentów WEJŚCIE program działa interaktywnie w bieżącym folderze. "
+            "Z argumentami (lub --batch) działa bez pytań i kończy się kodem: "
+            f"{EXIT_OK} = OK, {EXIT_ERROR} = błąd, {EXIT_NO_FILES} = brak plików Z*, "
+            f"{EXIT_INCOMPLETE} = dane niekompletne."
+        )
+    )
+    parser.add_argument(
+        "inputs", nargs="*", metavar="WEJŚCIE",
+        help="foldery lub wzorce plików (np. \"klienci/**/Z*.pdf\") — tryb wsadowy"
+    )
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="tryb wsadowy bez pytań dla bieżącego folderu"
+    )
+    parser.add_argument(
+        "-r", "--recursive", action="store_true",
+        help="przeszukuj też podfoldery podanych folderów"
+    )
+    parser.add_argument(
+        "--attachment-prefix", action="append", metavar="PREFIKS",
+        help="początek nazwy plików załączników (domyślnie Z; można podać kilka razy)"
+    )
+    parser.add_argument(
+        "--invoice-prefix", action="append", metavar="PREFIKS",
+        help="początek nazwy plików faktur (domyślnie 9 i 009; można podać kilka razy)"
+    )
+    parser.add_argument(
+        "-o", "--output", metavar="PLIK",
+        help="ścieżka pliku wynikowego (.xlsx lub .csv, domyślnie fv_waga.xlsx)"
+    )
+    parser.add_argument(
+        "--no-aggregates", action="store_true",
+        help="nie dodawaj arkuszy z sumami per FV i paczka oraz listy braków"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="tylko wypisz znalezione pliki, bez przetwarzania"
+    )
+    parser.add_argument(
+        "--print", action="store_true",
+        help="w trybie wsadowym wydrukuj znalezione faktury 9*"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1,
+        help="liczba procesów do ekstrakcji plików Z* (0 = liczba rdzeni, domyślnie 1)"
+    )
+    parser.add_argument(
+        "--file-timeout", type=float, default=120, metavar="SEKUNDY",
+        help="maksymalny czas ekstrakcji jednego pliku; zawieszony proces jest zabijany "
+             "(0 = bez limitu, domyślnie 120)"
+    )
+    parser.add_argument(
+        "--file-memory", type=int, default=2048, metavar="MB",
+        help="limit pamięci procesu ekstrakcji w MB, tylko Unix (0 = bez limitu, domyślnie 2048)"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help=f"nie używaj pamięci podręcznej wyników ({CACHE_FILE})"
+    )
+    parser.add_argument(
+        "--rebuild-cache", action="store_true",
+        help="wyczyść pamięć podręczną i przetwórz wszystkie pliki od nowa"
+    )
+    parser.add_argument(
+        "--cache-max-entries", type=int, default=50000,
+        help="maksymalna liczba wpisów w pamięci podręcznej (domyślnie 50000)"
+    )
+    parser.add_argument(
+        "--cache-max-age", type=int, default=90,
+        help="usuń wpisy nieużywane od tylu dni (domyślnie 90)"
+    )
+    parser.add_argument(
+        "--engine", choices=[*PDF_ENGINES, "auto"], default="pdfplumber",
+        help="silnik odczytu PDF; auto = pdfplumber, a brakujące pola z pypdf (domyślnie pdfplumber)"
+    )
+    parser.add_argument(
+        "--full-layout", action="store_true",
+        help="pomiń szybki odczyt tekstu i zawsze używaj pełnej analizy układu strony"
+    )
+    parser.add_argument(
+        "--max-pages", type=int, default=DEFAULT_MAX_PAGES,
+        help="maksymalna liczba stron czytanych z jednego pliku w każdym przebiegu "
+             "(0 = bez limitu, domyślnie); wiersze ucięte limitem nie trafiają do cache"
+    )
+    parser.add_argument(
+        "--ocr", action="store_true",
+        help="rozpoznawaj tekst (Tesseract) na zeskanowanych stronach bez warstwy tekstowej"
+    )
+    parser.add_argument(
+        "--ocr-workers", type=int, default=1,
+        help="liczba procesów OCR (domyślnie 1)"
+    )
+    parser.add_argument(
+        "--ocr-lang", default="pol",
+        help="język rozpoznawania Tesseract (domyślnie pol)"
+    )
+    parser.add_argument(
+        "--no-match", action="store_true",
+        help="nie dopasowuj faktur 9* do załączników Z* (bez arkusza Dopasowanie)"
+    )
+    parser.add_argument(
+        "--format", choices=OUTPUT_FORMATS, default="xlsx",
+        help="format pliku wynikowego, gdy nie podano --output (domyślnie xlsx)"
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="obserwuj folder i dopisuj nowe pliki Z* do arkusza na bieżąco"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=2.0,
+        help="co ile sekund sprawdzać folder w trybie --watch (domyślnie 2)"
+    )
+    parser.add_argument(
+        "--printer-cmd",
+        help='polecenie drukowania zamiast SumatraPDF, np. "lp -d biuro" ({files} = ścieżki plików)'
+    )
+    parser.add_argument(
+        "--print-batch", type=int, default=10,
+        help="liczba faktur w jednym zadaniu drukowania (domyślnie 10)"
+    )
+    parser.add_argument(
+        "--print-workers", type=int, default=1,
+        help="liczba równoległych zadań drukowania; 1 zachowuje kolejność (domyślnie 1)"
+    )
+    parser.add_argument(
+        "--print-timeout", type=float, default=300,
+        help="limit czasu jednego zadania drukowania w sekundach (domyślnie 300)"
+    )
+    parser.add_argument(
+        "--print-merge", action="store_true",
+        help="łącz faktury z jednego zadania w jeden plik PDF (jedno zadanie drukarki)"
+    )
+    parser.add_argument(
+        "--spool-dir", metavar="KATALOG", default=SPOOL_DIR,
+        help=f"katalog połączonych plików do druku (domyślnie {SPOOL_DIR})"
+    )
+    parser.add_argument(
+        "--reprint", metavar="KATALOG",
+        help="wydrukuj ponownie nieudane części z katalogu --print-merge i zakończ"
+    )
+    parser.add_argument(
+        "--chunk", type=int, action="append", metavar="NR",
+        help="z --reprint: tylko ta część (można podać kilka razy)"
+    )
+    parser.add_argument(
+        "--history", metavar="PLIK", default=HISTORY_FILE,
+        help=f"baza historii wyników wszystkich uruchomień (domyślnie {HISTORY_FILE})"
+    )
+    parser.add_argument(
+        "--no-history", action="store_true",
+        help="nie zapisuj wyników w historii"
+    )
+    parser.add_argument(
+        "--history-vat", metavar="NIP",
+        help="pokaż z historii paczki dla numeru VAT i zakończ"
+    )
+    parser.add_argument(
+        "--history-package", metavar="NR",
+        help="pokaż z historii wiersze dla numeru paczki i zakończ"
+    )
+    parser.add_argument(
+        "--history-daily", action="store_true",
+        help="pokaż z historii sumy wag i wartości na dzień i zakończ"
+    )
+    parser.add_argument(
+        "--since", metavar="RRRR-MM-DD",
+        help="zapytania historii: od dnia (włącznie)"
+    )
+    parser.add_argument(
+        "--until", metavar="RRRR-MM-DD",
+        help="zapytania historii: do dnia (włącznie)"
+    )
+    parser.add_argument(
+        "--export", metavar="PLIK",
+        help="zapisz wynik zapytania historii do pliku .xlsx lub .csv"
+    )
+    parser.add_argument(
+        "--shard-plan", metavar="KATALOG",
+        help="podziel pliki Z* z WEJŚCIA na części i zapisz manifest w katalogu"
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=500,
+        help="liczba plików w jednej części (domyślnie 500)"
+    )
+    parser.add_argument(
+        "--shard-run", metavar="KATALOG",
+        help="przetwórz niegotowe części z manifestu (można uruchomić na kilku komputerach)"
+    )
+    parser.add_argument(
+        "--shard", type=int, action="append", metavar="NR",
+        help="z --shard-run: tylko ta część (można podać kilka razy)"
+    )
+    parser.add_argument(
+        "--shard-status", metavar="KATALOG",
+        help="pokaż stan części manifestu"
+    )
+    parser.add_argument(
+        "--shard-merge", metavar="KATALOG",
+        help="połącz wyniki wszystkich części w jeden plik wynikowy"
+    )
+    parser.add_argument(
+        "--timings-report", metavar="PLIK",
+        help="zapisz czasy etapów i plików jako JSON lines"
+    )
+    parser.add_argument(
+        "--profile", metavar="PLIK",
+        help="zapisz profil wykonania (cProfile; .html = pyinstrument)"
+    )
+    args = parser.parse_args(argv)
+    if args.watch and (args.inputs or args.batch):
+        parser.error("--watch obserwuje bieżący folder; nie łącz go z folderami wejściowymi ani --batch")
+    set_prefix_rules(args.attachment_prefix, args.invoice_prefix)
+    if args.workers <= 0:
+        args.workers = os.cpu_count() or 1
+    if args.output is None:
+        args.output = f"fv_waga.{args.format}"
+    return args
+
+
+def open_cache(args, directory):
+    """
+    Open extraction cache unless disabled
+
+    :param args: Parsed command line options
+    :param directory: Directory holding the cache file
+    """
+    if args.no_cache:
+        return None
+    return ExtractionCache(
+        os.path.join(directory, CACHE_FILE),
+        max_entries=args.cache_max_entries,
+        max_age_days=args.cache_max_age,
+        rebuild=args.rebuild_cache,
+        variant=cache_variant(args)
+    )
+
+
+def cache_variant(args):
+    """
+    Cache variant of the extraction options changing the result
+
+    A run with a small --max-pages may miss fields; keying by the budget
+    keeps its partial rows from being served to runs reading more pages.
+
+    :param args: Parsed command line options
+    """
+    layout = "full" if args.full_layout else "fast"
+    return f"{args.engine}|{layout}|{args.max_pages or 'all'}"
+
+
+def open_history(args):
+    """
+    Open history store unless disabled
+
+    :param args: Parsed command line options
+    """
+    if args.no_history:
+        return None
+    return HistoryStore(args.history)
+
+
+def make_ocr_extractor(args, cache=None):
+    """
+    Build picklable OCR function from options, or None when OCR is off
+
+    :param args: Parsed command line options
+    :param cache: Optional ExtractionCache holding OCR page texts
+    """
+    if not args.ocr:
+        return None
+    reason = ocr_available()
+    if reason is not None:
+        print(f"  ⚠ OCR wyłączony: {reason}")
+        return None
+    return functools.partial(
+        ocr_missing_fields,
+        cache_path=cache.path if cache is not None else None,
+        lang=args.ocr_lang,
+        max_pages=args.max_pages
+    )
+
+
+def make_extractor(args, function=extract_vat_package_weight):
+    """
+    Build picklable extraction function from options
+
+    :param args: Parsed command line options
+    :param function: extract_vat_package_weight or extract_invoice_package
+    """
+    return functools.partial(
+        function, fast=not args.full_layout, engine=args.engine,
+        max_pages=args.max_pages or None
+    )
+
+
+def isolation_options(args):
+    """
+    Per-file limits for processing_founded_files from the command line
+
+    :param args: Parsed command line options
+    """
+    return {
+        "timeout": args.file_timeout or None,
+        "memory_mb": args.file_memory or None,
+    }
+
+
+def print_failures(failures):
+    """
+    Print files skipped because their extraction failed
+
+    :param failures: List of (file, reason)
+    """
+    if not failures:
+        return
+    print(f"\n⚠ Pominięte pliki (błąd ekstrakcji): {len(failures)}")
+    for file, reason in failures:
+        print(f"  • {file}: {reason}")
+
+
+def run_extraction(z_files, current_dir, args, timings, invoices=None, cancel=None,
+                   file_stats=None):
+    """
+    Extract Z* files into the output file and print summary
+
+    Shared by the interactive and batch mode. Returns (file_name, stats).
+    When ``invoices`` is given (and --no-match is not set), the invoices are
+    joined with the extracted rows into an extra "Dopasowanie" sheet.
+
+    :param z_files: Iterable of Z* file names (or absolute paths with empty current_dir)
+    :param current_dir: Directory containing the files
+    :param args: Parsed command line options
+    :param timings: Timings collector
+    :param invoices: 9* file names; may be filled while z_files is consumed
+    :param cancel: Optional threading.Event; once set, ExtractionCancelled is raised
+    :param file_stats: Optional {file: (size, mtime)} from the listing, for the cache
+    """
+    cache = open_cache(args, os.getcwd())
+    profiler = start_profiler(args.profile)
+
+    history = open_history(args)
+    ocr_extractor = make_ocr_extractor(args, cache)
+    sink = create_sink(args.output)
+    stats = RowStats()
+    failures = []
+    try:
+        with timings.stage("extract"):
+            if history is not None:
+                history.start_batch(os.path.abspath(args.output))
+            if history is not None or ocr_extractor is not None:
+                # Source paths run alongside the rows, which stay 4-tuples
+                z_files, sources = itertools.tee(z_files)
+                sources = (os.path.abspath(os.path.join(current_dir, f)) for f in sources)
+                if history is not None and ocr_extractor is not None:
+                    ocr_sources, history_sources = itertools.tee(sources)
+                else:
+                    ocr_sources = history_sources = sources
+            rows = processing_founded_files(
+                z_files, current_dir, workers=args.workers, cache=cache,
+                extractor=make_extractor(args), timings=timings,
+                failures=failures, cancel=cancel, stats=file_stats, **isolation_options(args)
+            )
+            if ocr_extractor is not None:
+                rows = ocr_rows(rows, ocr_sources, ocr_extractor,
+                                workers=args.ocr_workers, cache=cache, cancel=cancel,
+                                **isolation_options(args))
+            rows = count_rows(rows, stats)
+            if history is not None:
+                rows = store_rows(rows, history, history_sources)
+            write_rows(rows, sink)
+    finally:
+        if cache is not None:
+            print(f"\n  ℹ️  Pamięć podręczna: {cache.hits} z pamięci, {cache.misses} przetworzonych"
+                  f", {cache.unchanged} plików bez zmian (nieczytanych)")
+            cache.close()
+        if history is not None:
+            history.finish_batch()
+            print(f"  🗄️  Historia: zapisano {history.rows} wierszy ({history.path})")
+            history.close()
+
+    with timings.stage("summary"):
+        summary(stats)
+        print_failures(failures)
+        add_report_sheets(sink, stats, not args.no_aggregates)
+
+    if invoices and not args.no_match:
+        with timings.stage("match"):
+            matcher = InvoiceMatcher(stats)
+            report = matcher.match(iter_invoice_packages(
+                invoices, current_dir, workers=args.workers,
+                extractor=make_extractor(args, extract_invoice_package),
+                cancel=cancel, **isolation_options(args)
+            ))
+            sink.add_sheet("Dopasowanie", MATCH_HEADER, report.sheet_rows(stats))
+        print_match_report(report, len(invoices))
+
+    with timings.stage("excel"):
+        file_name = excel_create(sink)
+
+    stop_profiler(profiler, args.profile)
+    print_timings(timings)
+    return file_name, stats
+
+
+def run_batch(args):
+    """
+    Non-interactive run over many folders, returns process exit code
+
+    Inputs are listed lazily, so the first files are processed while later
+    folders are still being scanned.
+
+    :param args: Parsed command line options
+    """
+    timings = Timings(args.timings_report)
+    try:
+        # Size and mtime from the listing let the cache skip a stat per file
+        file_stats = None if args.no_cache or args.dry_run else {}
+        paths = iter_inputs(args.inputs or [os.getcwd()], args.recursive, file_stats)
+
+        if args.dry_run:
+            count = 0
+            for count, path in enumerate(paths, 1):
+                print(f"  • {path}")
+            print(f"📄 Znalezione pliki PDF: {count}")
+            return EXIT_OK
+
+        nine_paths = []
+
+        def extract(on_invoice=None, cancel=None):
+            z_paths = split_invoices(paths, nine_paths, on_invoice)
+            first = next(z_paths, None)
+            if first is None:
+                return None
+            return run_extraction(
+                itertools.chain([first], z_paths), "", args, timings, invoices=nine_paths,
+                cancel=cancel, file_stats=file_stats
+            )
+
+        scheduler = None
+        if args.print:
+            scheduler = make_scheduler(args)
+            if scheduler is None:
+                return EXIT_ERROR
+            # Invoices go to the printer as soon as discovery finds them
+            result = asyncio.run(extract_while_printing(extract, [], scheduler, timings))
+        else:
+            result = extract()
+        if scheduler is not None and scheduler.failed:
+            return EXIT_ERROR
+        if result is None:
+            print("⚠ UWAGA: Nie znaleziono żadnych plików Z*!")
+            return EXIT_NO_FILES
+
+        file_name, stats = result
+        print(f"\n  📁 Plik wynikowy: {os.path.abspath(file_name)}")
+        print(f"  📋 Faktury (9*): {len(nine_paths)}")
+
+        return EXIT_INCOMPLETE if stats.incomplete else EXIT_OK
+    except KeyboardInterrupt:
+        print("\n  ⏹️  Przerwano", file=sys.stderr)
+        return EXIT_ERROR
+    except Exception as e:
+        print(f"\n❌ BŁĄD KRYTYCZNY: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    finally:
+        timings.close()
+
+
+SHARD_MANIFEST = "manifest.json"
+SHARD_VERSION = 1
+# A lock not refreshed for this long belongs to a crashed or killed shard run;
+# a running shard touches its lock after every file
+SHARD_LOCK_TTL = 6 * 3600
+
+
+def write_json_atomic(path, data):
+    """
+    Write JSON so readers never see a half-written file
+
+    :param path: Target path
+    :param data: JSON-serialisable data
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f"{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(path) or "."
+    )
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+class ShardManifest:
+    """
+    Split of a Z* file list into shards in a directory on a shared disk
+
+    The manifest lists the files in output order and the shard ranges.
+    Per shard the directory holds:
+
+    - ``shard-NNNN.lock``: claimed by a running process
+    - ``shard-NNNN.json``: partial result, written atomically = shard done;
+      files that failed (timeout, crash, read error) are listed in it and
+      only they are read again by the next run
+    - ``shard-NNNN.failed``: last error, the shard is run again next time
+
+    File paths are stored relative to the manifest, so hosts may mount the
+    shared disk at different places.
+    """
+
+    def __init__(self, directory, files, shard_size, options):
+        self.directory = directory
+        self.files = files
+        self.shard_size = shard_size
+        self.options = options
+
+    @classmethod
+    def create(cls, directory, paths, shard_size, options):
+        """
+        Write a new manifest
+
+        :param directory: Shard directory (created if missing)
+        :param paths: Z* paths in output order
+        :param shard_size: Files per shard
+        :param options: Extraction options every shard must use
+        """
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for path in paths:
+            try:
+                files.append(os.path.relpath(path, directory))
+            except ValueError:
+                # Different drive on Windows
+                files.append(os.path.abspath(path))
+        manifest = cls(directory, files, shard_size, options)
+        write_json_atomic(os.path.join(directory, SHARD_MANIFEST), {
+            "version": SHARD_VERSION,
+            "created": time.time(),
+            "shard_size": shard_size,
+            "options": options,
+            "files": files,
+        })
+        return manifest
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Read the manifest of a shard directory
+
+        :param directory: Shard directory
+        """
+        with open(os.path.join(directory, SHARD_MANIFEST), encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != SHARD_VERSION:
+            raise ValueError(f"nieobsługiwana wersja manifestu: {data.get('version')}")
+        return cls(directory, data["files"], data["shard_size"], data["options"])
+
+    @property
+    def shard_count(self):
+        return -(-len(self.files) // self.shard_size)
+
+    def shard_files(self, shard):
+        """
+        Files of one shard as stored in the manifest
+
+        :param shard: Shard number
+        """
+        start = shard * self.shard_size
+        return self.files[start:start + self.shard_size]
+
+    def resolve(self, file):
+        """
+        Path of a manifest file as seen from this host
+
+        :param file: File as stored in the manifest
+        """
+        return os.path.normpath(os.path.join(self.directory, file))
+
+    def path(self, shard, suffix):
+        return os.path.join(self.directory, f"shard-{shard + 1:04d}.{suffix}")
+
+    def state(self, shard):
+        """
+        Return "done", "partial", "running", "failed" or "pending"
+
+        "partial" is a written shard with files that failed.
+
+        :param shard: Shard number
+        """
+        if os.path.exists(self.path(shard, "json")):
+            return "partial" if self.failed_files(shard) else "done"
+        lock = self.path(shard, "lock")
+        if os.path.exists(lock) and time.time() - os.path.getmtime(lock) < SHARD_LOCK_TTL:
+            return "running"
+        if os.path.exists(self.path(shard, "failed")):
+            return "failed"
+        return "pending"
+
+    def claim(self, shard):
+        """
+        Atomically take the lock of a shard, False when someone else has it
+
+        :param shard: Shard number
+        """
+        lock = self.path(shard, "lock")
+        for _ in range(2):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if time.time() - os.path.getmtime(lock) < SHARD_LOCK_TTL:
+                    return False
+                # Stale lock of a crashed run
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(lock)
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(f"{socket.gethostname()} {os.getpid()}\n")
+            return True
+        return False
+
+    def touch(self, shard):
+        """
+        Refresh the lock of a running shard, so it is not taken for stale
+
+        :param shard: Shard number
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self.path(shard, "lock"))
+
+    def release(self, shard):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(shard, "lock"))
+
+    def result(self, shard):
+        """
+        Read the written result of a shard
+
+        :param shard: Shard number
+        """
+        with open(self.path(shard, "json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def failed_files(self, shard):
+        """
+        [file, reason] of the files a written shard could not read
+
+        :param shard: Shard number
+        """
+        return self.result(shard).get("failed", [])
+
+    def rows(self, shard):
+        """
+        Yield (source, row) from a finished shard
+
+        :param shard: Shard number
+        """
+        for file, vat, weight, package, net_value in self.result(shard)["rows"]:
+            yield self.resolve(file), (vat, weight, package, net_value)
+
+
+def shard_options(args):
+    """
+    Extraction options recorded in the manifest
+
+    :param args: Parsed command line options
+    """
+    return {"engine": args.engine, "full_layout": args.full_layout, "max_pages": args.max_pages}
+
+
+def plan_shards(args):
+    """
+    Write a shard manifest for the Z* files of the inputs, returns exit code
+
+    :param args: Parsed command line options
+    """
+    paths = [path for path in iter_inputs(args.inputs or [os.getcwd()], args.recursive)
+             if is_attachment(os.path.basename(path))]
+    if not paths:
+        print("⚠ UWAGA: Nie znaleziono żadnych plików Z*!")
+        return EXIT_NO_FILES
+    manifest = ShardManifest.create(args.shard_plan, paths, args.shard_size, shard_options(args))
+    print(f"  ✓ Manifest: {os.path.join(args.shard_plan, SHARD_MANIFEST)}")
+    print(f"  ✓ Pliki Z*: {len(paths)} w {manifest.shard_count} częściach")
+    return EXIT_OK
+
+
+def run_shards(args):
+    """
+    Process unfinished shards of a manifest, returns exit code
+
+    Several processes or hosts may run this on the same directory; each
+    shard is claimed with a lock file. Finished shards are never redone,
+    failed ones are retried. Of a shard with failed files only those files
+    are read again.
+
+    :param args: Parsed command line options
+    """
+    manifest = ShardManifest.load(args.shard_run)
+    # Every shard uses the options from the plan, so partial results agree
+    for name, value in manifest.options.items():
+        setattr(args, name, value)
+    extractor = make_extractor(args)
+    shards = [number - 1 for number in args.shard] if args.shard else range(manifest.shard_count)
+    if any(not 0 <= shard < manifest.shard_count for shard in shards):
+        print(f"❌ Numery części muszą być w zakresie 1–{manifest.shard_count}", file=sys.stderr)
+        return EXIT_ERROR
+
+    cache = open_cache(args, os.getcwd())
+    failed = 0
+    partial = 0
+    failures = []
+    try:
+        for shard in shards:
+            if manifest.state(shard) == "done" or not manifest.claim(shard):
+                continue
+            # Another host may have finished the shard between the check and the claim
+            state = manifest.state(shard)
+            if state == "done":
+                manifest.release(shard)
+                continue
+            print(f"\n📦 Część {shard + 1}/{manifest.shard_count}")
+            start = time.perf_counter()
+            try:
+                files = manifest.shard_files(shard)
+                previous = {}
+                todo = files
+                if state == "partial":
+                    previous = {file: row for file, *row in manifest.result(shard)["rows"]}
+                    retry = {file for file, _ in manifest.failed_files(shard)}
+                    todo = [file for file in files if file in retry]
+                paths = {manifest.resolve(file): file for file in todo}
+                shard_failures = []
+                rows = processing_founded_files(
+                    list(paths), "", workers=args.workers, cache=cache, extractor=extractor,
+                    failures=shard_failures, **isolation_options(args)
+                )
+                for file, row in zip(todo, rows):
+                    previous[file] = row
+                    manifest.touch(shard)
+                failed_paths = {path for path, _ in shard_failures}
+                # Read errors give a row without any field; such files are tried again too
+                shard_failures += [
+                    (path, "nie odczytano żadnego pola") for path, file in paths.items()
+                    if path not in failed_paths and all(value is None for value in previous[file])
+                ]
+                write_json_atomic(manifest.path(shard, "json"), {
+                    "shard": shard,
+                    "host": socket.gethostname(),
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "rows": [[file, *previous[file]] for file in files],
+                    "failed": [[paths[path], reason] for path, reason in shard_failures],
+                })
+                failures += shard_failures
+                partial += bool(shard_failures)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(manifest.path(shard, "failed"))
+            except Exception as e:
+                failed += 1
+                print(f"  ❌ Część {shard + 1}: {e}")
+                write_json_atomic(manifest.path(shard, "failed"), {
+                    "host": socket.gethostname(), "error": str(e), "time": time.time()
+                })
+            finally:
+                manifest.release(shard)
+                if cache is not None:
+                    cache.commit()
+    finally:
+        if cache is not None:
+            cache.close()
+    print_failures(failures)
+    if failed:
+        return EXIT_ERROR
+    return EXIT_INCOMPLETE if partial else EXIT_OK
+
+
+def shard_status(args):
+    """
+    Print state of every shard, returns EXIT_OK when all are done
+
+    :param args: Parsed command line options
+    """
+    manifest = ShardManifest.load(args.shard_status)
+    states = collections.Counter()
+    print("\n\n📦 STAN CZĘŚCI")
+    print_separator()
+    for shard in range(manifest.shard_count):
+        state = manifest.state(shard)
+        states[state] += 1
+        if state == "failed":
+            with open(manifest.path(shard, "failed"), encoding="utf-8") as f:
+                error = json.load(f)
+            print(f"  ✗ Część {shard + 1}: {error['error']} ({error['host']})")
+        elif state == "partial":
+            for file, reason in manifest.failed_files(shard):
+                print(f"  ⚠ Część {shard + 1}: {file}: {reason}")
+    print(f"  Pliki Z*       : {len(manifest.files)}")
+    for state, label in (("done", "Gotowe"), ("partial", "Błędy plików"),
+                         ("running", "W toku"), ("failed", "Błędy"), ("pending", "Czekające")):
+        print(f"  {label:<15}: {states[state]}/{manifest.shard_count}")
+    print_separator()
+    return EXIT_OK if states["done"] == manifest.shard_count else EXIT_INCOMPLETE
+
+
+def merge_shards(args):
+    """
+    Rebuild the output file from all partial results, returns exit code
+
+    Rows are written in manifest order, so the output is the same as a
+    single run over the same files, whatever host finished which shard.
+    Files that failed in a shard get empty rows, as in a single run.
+
+    :param args: Parsed command line options
+    """
+    manifest = ShardManifest.load(args.shard_merge)
+    states = [manifest.state(shard) for shard in range(manifest.shard_count)]
+    missing = [shard + 1 for shard, state in enumerate(states) if state not in ("done", "partial")]
+    if missing:
+        print(f"❌ Niegotowe części: {', '.join(map(str, missing))}", file=sys.stderr)
+        return EXIT_ERROR
+    failures = [(file, reason) for shard, state in enumerate(states) if state == "partial"
+                for file, reason in manifest.failed_files(shard)]
+
+    history = open_history(args)
+
+    def merged_rows():
+        for shard in range(manifest.shard_count):
+            for source, row in manifest.rows(shard):
+                if history is not None:
+                    history.add(source, row)
+                yield row
+
+    sink = create_sink(args.output)
+    stats = RowStats()
+    try:
+        if history is not None:
+            history.start_batch(os.path.abspath(args.output))
+        write_rows(count_rows(merged_rows(), stats), sink)
+    finally:
+        if history is not None:
+            history.finish_batch()
+            history.close()
+
+    summary(stats)
+    print_failures(failures)
+    add_report_sheets(sink, stats, not args.no_aggregates)
+    file_name = excel_create(sink)
+    print(f"\n  📁 Plik wynikowy: {os.path.abspath(file_name)}")
+    return EXIT_INCOMPLETE if stats.incomplete else EXIT_OK
+
+
+def main():
+    args = parse_args()
+    if args.history_vat or args.history_package or args.history_daily:
+        sys.exit(run_history(args))
+    if args.reprint:
+        sys.exit(reprint_spool(args))
+    if args.shard_plan:
+        sys.exit(plan_shards(args))
+    if args.shard_run:
+        sys.exit(run_shards(args))
+    if args.shard_status:
+        sys.exit(shard_status(args))
+    if args.shard_merge:
+        sys.exit(merge_shards(args))
+    if args.inputs or args.batch:
+        sys.exit(run_batch(args))
+
+    try:
+        force_window_height()
+
+        current_dir = os.getcwd()
+        time.sleep(1)
+
+        print_header()
+
+        if args.watch:
+            cache = open_cache(args, current_dir)
+            try:
+                watch_folder(
+                    current_dir, cache=cache, workers=args.workers,
+                    interval=args.interval, extractor=make_extractor(args),
+                    file_name=args.output, **isolation_options(args)
+                )
+            finally:
+                if cache is not None:
+                    cache.close()
+            return
+
+        timings = Timings(args.timings_report)
+
+        file_stats = None if args.no_cache else {}
+        with timings.stage("discovery"):
+            z_files, nine_files = get_files_paths(current_dir, file_stats)
+        print_founded_files(z_files, nine_files)
+
+        # Asked before extraction, so printing runs alongside it
+        print_requested = False
+        if nine_files:
+            print(f"\n📋 Znaleziono {len(nine_files)} faktur (9*)")
+            response = input("\nCzy wydrukować faktury? [T/N]: ").strip().upper()
+            print_requested = response in ('T', 'TAK', 'Y', 'YES')
+
+        def extract(on_invoice=None, cancel=None):
+            return run_extraction(z_files, current_dir, args, timings, invoices=nine_files,
+                                  cancel=cancel, file_stats=file_stats)
+
+        if print_requested:
+            file_name, _ = asyncio.run(extract_while_printing(
+                extract, [os.path.join(current_dir, f) for f in nine_files],
+                make_scheduler(args), timings
+            ))
+        else:
+            file_name, _ = extract()
+
+        print("\n✅ ZAKOŃCZONO POMYŚLNIE")
+        print(f"\n  📁 Plik wynikowy: {file_name}")
+        print_separator()
+
+        print("\n\nNaciśnij ENTER aby otworzyć plik Excel...")
+        input()
+
+        print("📂 Otwieram plik Excel...")
+        try:
+            os.startfile(file_name)
+        except Exception as e:
+            print(f"❌ Błąd podczas otwierania pliku: {e}")
+
+        if not nine_files:
             print("\n  ℹ️  Brak faktur (9*) do wydruku")
+        elif not print_requested:
+            print("\n  ⏭️  Pominięto drukowanie")
+            print_separator()
+        timings.close()
 
         print("\n\nNaciśnij ENTER aby zakończyć...")
         input()
@@ -344,4 +4451,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()